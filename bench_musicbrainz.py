@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
+# General Public License v3.  See COPYING for details.
+
+# Benchmarks the streaming parser in musicbrainz.py against the DOM
+# parser it replaced, over recorded Web service search responses, and
+# checks that both produce the same field values.  The App Engine SDK
+# must be on PYTHONPATH.
+#
+# Usage: bench_musicbrainz.py [-n repeat] artist|release-group [file...]
+#
+# With no files, a synthetic response with 5000 results is used.
+
+import optparse
+import sys
+import time
+from xml.dom import minidom
+import musicbrainz
+mb = musicbrainz
+
+# The DOM parser that musicbrainz.py used to have.
+
+def domElements(content, tagName):
+    doc = minidom.parseString(content)
+    return doc.getElementsByTagNameNS(mb.mbns, tagName)
+
+def domField(elt, fieldName):
+    fields = elt.getElementsByTagNameNS(mb.mbns, fieldName)
+    if fields:
+        return fields[0]
+
+def domFieldValue(elt, fieldName):
+    field = domField(elt, fieldName)
+    if field:
+        field.normalize()
+        return ''.join(node.data for node in field.childNodes
+                       if node.nodeType == node.TEXT_NODE)
+
+def domArtist(elt):
+    return (elt.getAttributeNS(mb.extns, 'score'), elt.getAttribute('id'),
+            domFieldValue(elt, 'name'), domFieldValue(elt, 'sort-name'),
+            domFieldValue(elt, 'disambiguation'))
+
+def domReleaseGroup(elt):
+    return (elt.getAttributeNS(mb.extns, 'score'), elt.getAttribute('id'),
+            elt.getAttribute('type'), domArtist(domField(elt, 'artist')),
+            domFieldValue(elt, 'title'))
+
+def artistFields(a):
+    return (a.score, a.id, a.name, a.sortname, a.disambiguation)
+
+def releaseGroupFields(rg):
+    return (rg.score, rg.id, rg.type, artistFields(rg.artist), rg.title)
+
+parsers = {
+    'artist': (domArtist, mb.Artist, artistFields),
+    'release-group': (domReleaseGroup, mb.ReleaseGroup, releaseGroupFields),
+    }
+
+def synthesize(resource, n):
+    def artist(i):
+        return ('<artist id="a%d" type="Group" ext:score="%d">'
+                '<name>Artist &amp; %d</name>'
+                '<sort-name>%d, Artist</sort-name>'
+                '<disambiguation>the %dth</disambiguation></artist>'
+                % (i, 100 - i % 100, i, i, i))
+    if resource == 'artist':
+        results = [artist(i) for i in range(n)]
+    else:
+        results = ['<release-group id="rg%d" type="Album" ext:score="%d">'
+                   '<title>Title %d</title>%s</release-group>'
+                   % (i, 100 - i % 100, i, artist(i)) for i in range(n)]
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<metadata xmlns="%s" xmlns:ext="%s"><%s-list count="%d">%s'
+            '</%s-list></metadata>'
+            % (mb.mbns, mb.extns, resource, n, ''.join(results), resource))
+
+def timed(repeat, func):
+    start = time.time()
+    for i in range(repeat):
+        result = func()
+    return (time.time() - start) / repeat, result
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-n repeat] artist|release-group [file...]')
+    parser.add_option('-n', type='int', dest='repeat', default=5)
+    options, args = parser.parse_args()
+    if not args or args[0] not in parsers:
+        parser.error('specify artist or release-group')
+    resource, files = args[0], args[1:]
+    domParse, cls, fields = parsers[resource]
+    if files:
+        responses = [(f, open(f).read()) for f in files]
+    else:
+        responses = [('synthetic', synthesize(resource, 5000))]
+    for name, content in responses:
+        domTime, expected = timed(options.repeat, lambda:
+            [domParse(elt) for elt in domElements(content, resource)])
+        streamTime, actual = timed(options.repeat, lambda:
+            [fields(cls(elt=elt))
+             for elt in mb.iterElements(content, resource)])
+        if actual != expected:
+            print '%s: results differ!' % name
+            sys.exit(1)
+        print '%s: %d results, %d bytes' % (name, len(actual), len(content))
+        print '  DOM:       %8.3f s' % domTime
+        print '  streaming: %8.3f s (%.1fx)' % (streamTime,
+                                                domTime / streamTime)
+
+if __name__ == '__main__':
+    main()
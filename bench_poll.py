@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
+# General Public License v3.  See COPYING for details.
+
+# Benchmarks counting, ranking and rendering a synthetic poll on the
+# local datastore stub.  For each operation it reports the wall time,
+# the number of API calls (datastore calls separately) and how far the
+# operation's peak resident memory rose above what the process held
+# when it started, and appends them as JSON lines to the
+# output file, tagged with the git revision, so that runs of different
+# revisions can be compared.  The App Engine SDK and its Django must be
+# on PYTHONPATH.
+#
+# Usage: bench_poll.py [-n repeat] [-v voters] [-r releases]
+#                      [-c votes,per,category] [-s skew] [-o output]
+#
+# Each ballot votes for distinct releases drawn with probability
+# proportional to 1/rank**skew, so a higher skew concentrates the votes
+# on fewer releases.
+
+import bisect
+import collections
+import datetime
+import gc
+import optparse
+import os
+import random
+import resource
+import subprocess
+import threading
+import time
+from django.utils import simplejson
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+import webob
+from main import application
+from models import Poll, Voter, Ballot, Vote, Artist, Release, \
+    RankedRelease, RankJob
+import musicbrainz
+mb = musicbrainz
+
+# Counts the API calls made, by service.
+class CallCounter(object):
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+
+    def __call__(self, service, call, request, response):
+        self.counts[service] += 1
+
+def setUp():
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    # For queue.yaml.
+    bed.init_taskqueue_stub(root_path=os.path.dirname(__file__) or '.')
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    counter = CallCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench', counter)
+    return bed, counter
+
+def putAll(entities, batchSize=500):
+    for i in range(0, len(entities), batchSize):
+        db.put(entities[i:i+batchSize])
+    return entities
+
+# Stores a closed poll for year with the given numbers of voters and
+# releases and a ballot per voter with votesPerCategory votes in each
+# category.  Returns the Poll.
+def generate(year, numVoters, numReleases, votesPerCategory, skew, seed):
+    rnd = random.Random(seed)
+    artists = putAll([Artist(name='Artist %d' % i, sortname='artist %d' % i)
+                      for i in range(max(1, numReleases / 3))])
+    releases = putAll([Release(artist=artists[i % len(artists)],
+                               title='Title %d' % i)
+                       for i in range(numReleases)])
+    total = 0
+    cumulative = []
+    for i in range(numReleases):
+        total += 1.0 / (i + 1) ** skew
+        cumulative.append(total)
+    voters = putAll([Voter(user=users.User('voter%d@example.com' % i),
+                           name='Voter %d' % i, year=year)
+                     for i in range(numVoters)])
+    ballots = putAll([Ballot(voter=v, year=year,
+                             honorable=votesPerCategory[1],
+                             notable=votesPerCategory[2])
+                      for v in voters])
+    votes = []
+    for b in ballots:
+        n = min(sum(votesPerCategory), numReleases)
+        chosen = []
+        while len(chosen) < n:
+            i = bisect.bisect(cumulative, rnd.random() * total)
+            if i not in chosen:
+                chosen.append(i)
+        ballotVotes = []
+        for category, count in zip(Ballot.categories, votesPerCategory):
+            for rank in range(1, count + 1):
+                if not chosen:
+                    break
+                i = chosen.pop(0)
+                r = releases[i]
+                name = artists[i % len(artists)].name
+                ballotVotes.append(Vote(parent=b, ballot=b, year=year,
+                                        category=category, rank=rank,
+                                        release=r, artist=name, title=r.title,
+                                        sortartist=mb.normalizeName(name)))
+        b.setVoteCounts(ballotVotes)
+        votes.extend(ballotVotes)
+    putAll(votes)
+    putAll(ballots)
+    poll = Poll(year=year, votingIsOpen=False)
+    poll.put()
+    return poll
+
+# Returns the resident memory of the process in KB.  Without /proc,
+# it falls back to the lifetime peak, which can't show an operation's
+# own peak once an earlier one has set it.
+def rss():
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Samples the resident memory in a thread while func runs, and returns
+# the peak above the memory at the start, in KB.
+def peakRSS(func, interval=0.005):
+    base = rss()
+    peak = [base]
+    done = threading.Event()
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], rss())
+            time.sleep(interval)
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        func()
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak[0], rss()) - base
+
+# Runs func repeat times, and returns a result record with the best
+# wall time, the calls made by the last run and the largest peak memory
+# of any run.
+def measure(counter, repeat, name, func):
+    best = None
+    peak = 0
+    for i in range(repeat):
+        gc.collect()
+        counter.counts.clear()
+        start = time.time()
+        peak = max(peak, peakRSS(func))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    record = { 'operation': name,
+               'wall_s': round(best, 6),
+               'rpcs': sum(counter.counts.values()),
+               'datastore_rpcs': counter.counts['datastore_v3'],
+               'peak_rss_kb': peak }
+    print '%-24s %9.3f s %7d calls %7d datastore %9d KB' % (
+        name, record['wall_s'], record['rpcs'], record['datastore_rpcs'],
+        record['peak_rss_kb'])
+    return record
+
+def get(path):
+    response = webob.Request.blank(path).get_response(application)
+    assert response.status_int == 200, (path, response.status)
+    return response
+
+def revision():
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                               stdout=subprocess.PIPE)
+        return git.communicate()[0].strip()
+    except OSError:
+        return None
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-n repeat] [-v voters] [-r releases] '
+        '[-c votes,per,category] [-s skew] [-o output]')
+    parser.add_option('-n', type='int', dest='repeat', default=1)
+    parser.add_option('-v', type='int', dest='voters', default=100)
+    parser.add_option('-r', type='int', dest='releases', default=1000)
+    parser.add_option('-c', dest='votes', default='10,10,10')
+    parser.add_option('-s', type='float', dest='skew', default=1.0)
+    parser.add_option('-y', type='int', dest='year', default=2010)
+    parser.add_option('--seed', type='int', dest='seed', default=0)
+    parser.add_option('-o', dest='output', default='bench_output.txt')
+    options, args = parser.parse_args()
+    votes = [int(n) for n in options.votes.split(',')]
+    if len(votes) != len(Ballot.categories):
+        parser.error('give one number of votes per category')
+
+    bed, counter = setUp()
+    params = dict(voters=options.voters, releases=options.releases,
+                  votesPerCategory=votes, skew=options.skew,
+                  seed=options.seed)
+    start = time.time()
+    poll = generate(options.year, options.voters, options.releases, votes,
+                    options.skew, options.seed)
+    print 'Generated the poll in %.3f s' % (time.time() - start)
+
+    def cacheChunks():
+        job = RankJob.get_by_key_name(str(poll.year))
+        for chunk in range(job.numChunks):
+            RankedRelease.cacheAll([rr for rr in db.get(job.chunkKeys(chunk))
+                                    if rr])
+    operations = [
+        ('reconcileCounters', poll.reconcileCounters),
+        ('tallyVotes', poll.tallyVotes),
+        ('countVotes', poll.countVotes),
+        ('rankedReleases', poll.rankedReleases),
+        ('rankReleases', poll.rankReleases),
+        ('RankedRelease.cacheAll', cacheChunks),
+        ]
+    for name in Poll.pages:
+        def cold(name=name):
+            poll.flush()
+            get(poll.url(name))
+        operations.append(('PollPage %s cold' % name, cold))
+        operations.append(('PollPage %s cached' % name,
+                           lambda name=name: get(poll.url(name))))
+
+    results = [measure(counter, options.repeat, name, func)
+               for name, func in operations]
+    common = dict(revision=revision(), params=params,
+                  date=datetime.datetime.utcnow().isoformat())
+    out = open(options.output, 'a')
+    for record in results:
+        record.update(common)
+        out.write(simplejson.dumps(record, sort_keys=True) + '\n')
+    out.close()
+    bed.deactivate()
+
+if __name__ == '__main__':
+    main()
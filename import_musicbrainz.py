@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
+# General Public License v3.  See COPYING for details.
+
+# Imports the artists or release groups from a MusicBrainz JSON data
+# dump, which has one record per line, into the local store that
+# musicbrainz.py consults before the Web service.  The dump is read a
+# line at a time, and after each batch is stored the offset of the next
+# line is saved in a checkpoint file next to the dump, so running the
+# same command again resumes an interrupted import.  Records that
+# can't be converted are skipped and listed.
+#
+# Usage: import_musicbrainz.py [-b batch] [-d sdk] app_id artist|release-group
+#                              dumpfile [host]
+
+import getpass
+import json
+import optparse
+import os
+import sys
+
+def auth_func():
+    return raw_input('Username:'), getpass.getpass('Password:')
+
+# Truncates a string to the length of a StringProperty.
+def short(s):
+    return (s or '')[:500] or None
+
+def artist(record):
+    return mb.LocalArtist(key_name=record['id'],
+                          name=short(record['name']),
+                          sortname=short(record.get('sort-name')),
+                          disambiguation=short(record.get('disambiguation')),
+                          normname=short(mb.normalizeName(record['name'])))
+
+# Returns None for a release group without an artist credit, which
+# can't be searched for by artist.
+def releaseGroup(record):
+    credits = record.get('artist-credit') or [{}]
+    credit = credits[0].get('artist')
+    if not credit or not credit.get('id'):
+        return None
+    return mb.LocalReleaseGroup(
+        key_name=record['id'],
+        type=short(record.get('primary-type')),
+        title=short(record['title']),
+        normtitle=short(mb.normalizeName(record['title'])),
+        artistid=credit['id'],
+        artistname=short(credit['name']),
+        artistsortname=short(credit.get('sort-name')),
+        normartist=short(mb.normalizeName(credit['name'])))
+
+converters = { 'artist': artist, 'release-group': releaseGroup }
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-b batch] [-d sdk] app_id artist|release-group '
+        'dumpfile [host]')
+    parser.add_option('-b', type='int', dest='batch', default=200)
+    parser.add_option('-d', dest='sdk', default='/home/dougo/google_appengine')
+    options, args = parser.parse_args()
+    if len(args) not in (3, 4) or args[1] not in converters:
+        parser.error('specify an app id, a record type and a dump file')
+    app_id, resource, dumpfile = args[:3]
+    if len(args) > 3:
+        host = args[3]
+    else:
+        host = '%s.appspot.com' % app_id
+
+    sys.path.insert(0, options.sdk)
+    sys.path.append(options.sdk + '/lib/yaml/lib')
+    sys.path.append(options.sdk + '/lib/webob')
+    global mb
+    from google.appengine.ext.remote_api import remote_api_stub
+    from google.appengine.ext import db
+    import musicbrainz as mb
+    remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api',
+                                             auth_func, host)
+
+    convert = converters[resource]
+    checkpoint = dumpfile + '.offset'
+    offset = 0
+    if os.path.exists(checkpoint):
+        offset = int(open(checkpoint).read())
+        print 'Resuming at offset %d' % offset
+    dump = open(dumpfile)
+    dump.seek(offset)
+    count = 0
+    skipped = 0
+    while True:
+        batch = []
+        while len(batch) < options.batch:
+            line = dump.readline()
+            if not line:
+                break
+            if line.strip():
+                record = json.loads(line)
+                entity = convert(record)
+                if entity:
+                    batch.append(entity)
+                else:
+                    skipped += 1
+                    print 'Skipped %s' % record.get('id')
+        if not batch:
+            break
+        db.put(batch)
+        count += len(batch)
+        # Only written once the batch is stored, so a batch is at worst
+        # stored twice, which is harmless since the keys are MBIDs.
+        open(checkpoint, 'w').write(str(dump.tell()))
+        print '%d records imported, offset %d' % (count, dump.tell())
+    print 'Done; %d records skipped.' % skipped
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,19 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 import itertools
 from google.appengine.api import users
 from google.appengine.ext import db
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 from django.utils import simplejson
-from models import Voter, Poll, Ballot, Vote, Release, Artist, Globals, RankedRelease
+from models import Voter, Poll, Ballot, Vote, Release, Artist, Globals, \
+    RankedRelease, VoteCounter, RankJob, PageCache, Generation, NameIndex, \
+    Backup, BackupChunk, CanonQueue, CounterMarker, CountersBusy, prefetch
 import musicbrainz
 mb = musicbrainz
+import rpcstats
+import calendar
+import email.utils
 import time
 import logging
 
@@ -25,6 +31,48 @@ class Page(webapp.RequestHandler):
         rendered = self.getRendered(template_file, **template_values)
         self.response.out.write(rendered)
 
+    # Writes a page from PageCache, first calling render to render it if
+    # it's not cached.  The cache key includes the named generations
+    # (see PageCache.generationKey), so the page is rendered again
+    # whenever any of them change.
+    def writeCachedPage(self, names, render):
+        keyName = PageCache.generationKey(names)
+        page = PageCache.fetch(keyName)
+        if not page:
+            page = PageCache.store(keyName, render())
+        self.writeCached(page)
+
+    # Writes a PageCache, with validators for conditional requests.
+    # Clients that accept gzip get the compressed content as is.  For
+    # other clients the page is decompressed in chunks, but the runtime
+    # buffers the whole response, so it still holds the full page.
+    def writeCached(self, page):
+        gzipped = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        etag = '"%s%s"' % (page.etag, '-gzip' if gzipped else '')
+        modified = email.utils.formatdate(
+            calendar.timegm(page.modified.utctimetuple()), usegmt=True)
+        headers = self.response.headers
+        headers['ETag'] = etag
+        headers['Last-Modified'] = modified
+        headers['Vary'] = 'Accept-Encoding'
+        match = self.request.headers.get('If-None-Match')
+        if match:
+            notModified = (match.strip() == '*' or
+                           etag in [m.strip() for m in match.split(',')])
+        else:
+            since = self.request.headers.get('If-Modified-Since')
+            notModified = bool(since) and since.split(';')[0].strip() == modified
+        if notModified:
+            self.response.set_status(304)
+            return
+        headers['Content-Type'] = 'text/html; charset=utf-8'
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+            self.response.out.write(page.content)
+        else:
+            for chunk in page.text():
+                self.response.out.write(chunk)
+
 # Base class for member pages.
 class MemberPage(Page):
     # Returns:
@@ -73,6 +121,8 @@ class ProfilePage(MemberPage):
         self.voter.name = self.request.get('name') or self.voter.user.nickname()
         self.voter.url = self.request.get('url')
         self.voter.put()
+        # The voter's name is on every page listing the voter's votes.
+        Generation.bump(['global'])
         self.redirect('..')
         
 class VotePage(MemberPage):
@@ -120,17 +170,18 @@ class VotePage(MemberPage):
         votes = dict()
         if self.voter.wantsPlain:
             # Fill in gaps in the ranking with blank Votes.
+            index = self.ballot.getVoteIndex()
             for category in Ballot.categories:
                 if category == Ballot.categories[0]:
                     max = 20
                 else:
                     max = self.ballot.maxRank(category)
-                votes[category] = [self.ballot.getVote(category, rank)
+                votes[category] = [index.get((category, rank)) or
+                                   self.ballot.newVote(category, rank)
                                    for rank in range(1, max+1)]
         else:
-            for category in Ballot.categories:
-                votes[category] = [vote.toDict()
-                                   for vote in self.ballot.getVotes(category)]
+            for category, categoryVotes in self.ballot.getVotesDict().items():
+                votes[category] = [vote.toDict() for vote in categoryVotes]
             votes = simplejson.dumps(votes, indent=4)
 
         self.years.remove(self.year)
@@ -141,29 +192,33 @@ class VotePage(MemberPage):
         if not self.validate():
             return
 
-        votes = set(self.ballot.vote_set)
         addCat = self.request.get('add')
         # IE submits the button label rather than the value attribute.  :(
         if addCat.find('honorable') != -1:
             addCat = 'honorable'
         if addCat.find('notable') != -1:
             addCat = 'notable'
-        db.run_in_transaction(self.update, votes, addCat)
+        db.run_in_transaction(self.update, addCat)
         if addCat:
             self.redirect(self.request.uri + '#_' + addCat)
         else:
             self.redirect(self.request.uri)
 
-    def update(self, votes, addCat):
-        # Delete the old votes and replace them with the request data.
-        # This avoids cases where the form data doesn't match the
-        # current database (e.g. from the back button or a cloned
-        # window).
+    def update(self, addCat):
+        # Make the stored votes match the request data, row by row.
+        # Every row is submitted, so this also corrects cases where the
+        # form data doesn't match the current database (e.g. from the
+        # back button or a cloned window).  Rows whose artist and title
+        # are unchanged keep their canonicalized release.
         if self.ballot:
-            db.delete(votes)
-            ballot = self.ballot
+            ballot = db.get(self.ballot.key())
+            stored = list(Vote.all().ancestor(ballot))
         else:
             ballot = Ballot(voter=self.voter, year=self.year)
+            ballot.put() # so that it can be the parent of new votes
+            stored = []
+        before = Ballot.countedReleases(stored)
+        uncanonicalized = Ballot.countUncanonicalized(stored)
 
         ballot.anonymous = bool(self.request.get('anonymous'))
         ballot.preamble = self.request.get('preamble')
@@ -177,18 +232,41 @@ class VotePage(MemberPage):
         ballot.notable = numVotes['notable']
         if addCat == 'notable':
             ballot.notable += 10
-        ballot.put()
 
+        old = dict()
+        delete = []
+        for vote in stored:
+            if (vote.category, vote.rank) in old:
+                delete.append(vote) # a duplicate row
+            else:
+                old[vote.category, vote.rank] = vote
+        put = []
         for cat in Ballot.categories:
             for rank in range(1, numVotes[cat]+1):
                 artist = self.request.get('%s%dartist' % (cat, rank))
                 title = self.request.get('%s%dtitle' % (cat, rank))
                 comments = self.request.get('%s%dcomments' % (cat, rank))
-                if artist or title or comments:
-                    vote = Vote(parent=ballot, ballot=ballot,
-                                category=cat, rank=rank,
-                                artist=artist, title=title, comments=comments)
-                    vote.put()
+                vote = old.pop((cat, rank), None)
+                if not (artist or title or comments):
+                    if vote:
+                        delete.append(vote)
+                elif not vote:
+                    put.append(Vote(parent=ballot, ballot=ballot,
+                                    year=ballot.year, category=cat, rank=rank,
+                                    artist=artist, title=title,
+                                    comments=comments))
+                elif (vote.artist, vote.title, vote.comments) != \
+                        (artist, title, comments):
+                    if (vote.artist, vote.title) != (artist, title):
+                        vote.release = None
+                    vote.artist = artist
+                    vote.title = title
+                    vote.comments = comments
+                    put.append(vote)
+        # Rows no longer on the form.
+        delete.extend(old.values())
+        ballot.saveVotes(put=put, delete=delete, stored=stored, before=before,
+                         uncanonicalized=uncanonicalized, putBallot=True)
 
 class AjaxHandler(MemberPage):
     def post(self):
@@ -205,31 +283,108 @@ class AjaxHandler(MemberPage):
         rank = int(rank) if rank else 0
 
         if category:
-            vote = self.ballot.getVote(category, rank)
-            if field == 'artist':
-                vote.artist = value
-            if field == 'title':
-                vote.title = value
-            if field == 'comments':
-                vote.comments = value
-            if vote.artist or vote.title or vote.comments:
-                vote.put()
-                if category == 'honorable' and rank > self.ballot.honorable:
-                    self.ballot.honorable = rank
-                    self.ballot.put()
-                if category == 'notable' and rank > self.ballot.notable:
-                    self.ballot.notable = rank
-                    self.ballot.put()
-            else:
-                vote.delete()
+            db.run_in_transaction(self.updateVote, field, value,
+                                  category, rank)
         else:
+            db.run_in_transaction(self.updateBallot, field, value)
+
+    # Sets a field of the ballot, reloaded so that the vote counts
+    # stored by a concurrent save are kept.
+    def updateBallot(self, field, value):
+        ballot = db.get(self.ballot.key())
+        if field == 'anonymous':
+            ballot.anonymous = (value == 'on')
+        if field == 'preamble':
+            ballot.preamble = value
+        if field == 'postamble':
+            ballot.postamble = value
+        ballot.put()
+
+    def updateVote(self, field, value, category, rank):
+        ballot = db.get(self.ballot.key())
+        stored = list(Vote.all().ancestor(ballot))
+        vote = ([v for v in stored if (v.category, v.rank) == (category, rank)]
+                or [ballot.newVote(category, rank)])[0]
+        if field == 'artist':
+            vote.artist = value
+        if field == 'title':
+            vote.title = value
+        if field == 'comments':
+            vote.comments = value
+        if vote.artist or vote.title or vote.comments:
+            extended = False
+            if category == 'honorable' and rank > ballot.honorable:
+                ballot.honorable = rank
+                extended = True
+            if category == 'notable' and rank > ballot.notable:
+                ballot.notable = rank
+                extended = True
+            ballot.saveVotes(put=[vote], stored=stored, putBallot=extended)
+        elif vote.is_saved():
+            ballot.saveVotes(delete=[vote], stored=stored)
+
+# Saves a batch of changes to the current ballot, sent as JSON by the
+# JavaScript form.
+class AutosaveHandler(MemberPage):
+    def post(self):
+        status = self.validate()
+        if status:
+            self.response.out.write(status)
+            self.response.set_status(401) # Unauthorized
+            return
+        try:
+            changes = simplejson.loads(self.request.body)
+        except ValueError:
+            self.response.out.write('Invalid changes.')
+            self.response.set_status(400) # Bad Request
+            return
+        db.run_in_transaction(self.update, changes)
+        self.response.out.write('Saved.')
+
+    # Applies the changes, a dict with an optional 'ballot' dict
+    # mapping ballot fields to values, and an optional 'votes' list of
+    # dicts with the category, rank, field and value of each change to
+    # a vote.  All the changed entities are stored with one put.
+    def update(self, changes):
+        ballot = db.get(self.ballot.key())
+        for field, value in changes.get('ballot', {}).items():
             if field == 'anonymous':
-                self.ballot.anonymous = (value == 'on')
+                ballot.anonymous = (value == 'on')
             if field == 'preamble':
-                self.ballot.preamble = value
+                ballot.preamble = value
             if field == 'postamble':
-                self.ballot.postamble = value
-            self.ballot.put()
+                ballot.postamble = value
+
+        stored = list(Vote.all().ancestor(ballot))
+        votes = dict(((v.category, v.rank), v) for v in stored)
+        changed = dict()
+        for change in changes.get('votes', []):
+            category = change.get('category')
+            rank = int(change.get('rank') or 0)
+            field = change.get('field')
+            if (category not in Ballot.categories or rank < 1 or
+                field not in ['artist', 'title', 'comments']):
+                continue
+            vote = votes.get((category, rank))
+            if not vote:
+                vote = ballot.newVote(category, rank)
+                votes[category, rank] = vote
+            setattr(vote, field, change.get('value') or '')
+            changed[category, rank] = vote
+
+        put = []
+        delete = []
+        for vote in changed.values():
+            if vote.artist or vote.title or vote.comments:
+                put.append(vote)
+                if vote.category == 'honorable':
+                    ballot.honorable = max(ballot.honorable, vote.rank)
+                if vote.category == 'notable':
+                    ballot.notable = max(ballot.notable, vote.rank)
+            elif vote.is_saved():
+                delete.append(vote)
+        ballot.saveVotes(put=put, delete=delete, stored=stored,
+                         putBallot=True)
 
 class MainPage(Page):
     def get(self):
@@ -243,21 +398,43 @@ class PollPage(Page):
             self.response.out.write('No poll results for ' + year + '.')
             return
         name = name or 'results'
-        rendered = getattr(poll, name)
-        if not rendered:
-            rendered = self.getRendered(name + '.html', poll=poll,
-                                        time=time.ctime())
-            setattr(poll, name, rendered)
-            poll.put()
-        self.response.out.write(rendered)
-
+        page = PageCache.fetch(poll.pageKey(name))
+        if not page:
+            page = PageCache.store(poll.pageKey(name),
+                                   self.renderChunks(poll, name))
+        self.writeCached(page)
+
+    rankedMarker = '<!-- ranked releases -->'
+
+    # Yields a poll page in chunks.  The ranked releases on the byvotes
+    # and byartist pages are not rendered by the template: their cached
+    # HTML is spliced in at the marker, one query batch at a time.
+    def renderChunks(self, poll, name):
+        rendered = self.getRendered(name + '.html', poll=poll,
+                                    time=time.ctime(), rows=self.rankedMarker)
+        if name == 'byvotes':
+            q = poll.byVotes()
+        elif name == 'byartist':
+            q = poll.byArtist()
+        else:
+            yield rendered
+            return
+        head, tail = rendered.split(self.rankedMarker, 1)
+        yield head
+        for html in poll.rankedHTML(q):
+            yield '\n    %s\n  ' % html
+        yield tail
+
+# The voter, ballot and artist pages of closed polls change only when
+# the data on them is edited, so they are cached.
 class VoterPage(Page):
     def get(self, id):
         voter = Voter.get_by_id(int(id))
         if not voter:
             self.response.out.write('No such voter: ' + id)
             return
-        self.render('voter.html', voter=voter)
+        self.writeCachedPage(['voter/' + id], lambda:
+                             self.getRendered('voter.html', voter=voter))
 
 class BallotPage(Page):
     def get(self, id):
@@ -265,14 +442,21 @@ class BallotPage(Page):
         if not ballot:
             self.response.out.write('No such ballot: ' + id)
             return
-        votes = ballot.getVotesDict()
-        self.render('ballot.html', ballot=ballot, votes=votes)
+        def render():
+            votes = ballot.getVotesDict()
+            return self.getRendered('ballot.html', ballot=ballot, votes=votes)
+        if ballot.year in Poll.openYears():
+            self.response.out.write(render())
+        else:
+            self.writeCachedPage(['ballot/' + id], render)
         
 class ArtistPage(Page):
     def get(self, id):
         artist = Artist.get_by_id(int(id))
         if artist:
-            self.render('artist.html', artist=artist)
+            self.writeCachedPage(['artist/' + id], lambda:
+                                 self.getRendered('artist.html', artist=artist,
+                                                  releases=artist.releaseVotes()))
         else:
             self.response.out.write('No such artist: ' + id)
 
@@ -281,18 +465,31 @@ class AdminPage(Page):
         self.render('admindex.html', polls=Poll.gql('ORDER BY year DESC'))
 
 class AdminPollPage(Page):
+    pageSize = 100
+
     def get(self, year):
         poll = Poll.get(year)
         if not poll:
             self.response.out.write('No poll for ' + year + '.')
             return
-        unc = []
-        for b in poll.ballots():
-            unc.extend(Vote.gql('WHERE ballot = :1 AND release = :2', b, None))
-        unc.sort(key=lambda v: v.artist.lower())
-        self.render('admin.html', poll=poll, unc=unc)
+        # One page of the uncanonicalized votes, grouped.
+        q = poll.uncanonicalizedVotes()
+        cursor = self.request.get('cursor')
+        if cursor:
+            q.with_cursor(cursor)
+        votes = q.fetch(self.pageSize)
+        if len(votes) == self.pageSize:
+            cursor = q.cursor()
+        else:
+            cursor = None
+        prefetch(votes, 'ballot.voter')
+        job = RankJob.get_by_key_name(str(poll.year))
+        done, failed = job.progress() if job else ([], [])
+        self.render('admin.html', poll=poll, groups=Vote.groups(votes),
+                    cursor=cursor, queue=CanonQueue.forYear(poll.year),
+                    job=job, done=done, failed=failed)
     def post(self, year):
-        Poll.get(year).rankReleases()
+        Poll.get(year).rankReleases(full=bool(self.request.get('full')))
         # TO DO: status page (with auto-refresh?)
         self.redirect('')
 
@@ -303,8 +500,148 @@ class FlushCachePage(Page):
             self.response.out.write('No poll for ' + year + '.')
             return
         poll.flush()
+        # Render the pages again now, rather than on the next visit.
+        for name in Poll.pages:
+            taskqueue.add(url=poll.url(name), method='GET')
         self.response.out.write('Flushed.')
 
+# Caches a chunk of a year's ranked releases for a RankJob.
+class CacheChunkPage(Page):
+    def post(self, year):
+        generation = int(self.request.get('generation'))
+        chunk = int(self.request.get('chunk'))
+        job = RankJob.get_by_key_name(year)
+        if not job or job.generation != generation:
+            self.response.out.write('Stale chunk: ' + year + '/' +
+                                    str(chunk))
+            return
+        try:
+            rrs = db.get(job.chunkKeys(chunk))
+            RankedRelease.cacheAll([rr for rr in rrs if rr])
+        except Exception, e:
+            RankJob.finishChunk(job.year, generation, chunk,
+                                error='%s: %s' % (type(e).__name__, e))
+            raise
+        RankJob.finishChunk(job.year, generation, chunk)
+        self.response.out.write('Cached.')
+
+# Adds the tasks for a RankJob's failed chunks again.
+class RetryRankJobPage(Page):
+    def post(self, year):
+        job = RankJob.get_by_key_name(year)
+        if job:
+            job.retry()
+        self.redirect('./')
+
+# Applies the changes to the vote counters enqueued by
+# VoteCounter.update.
+class VoteCounterPage(Page):
+    def post(self):
+        taskName = self.request.headers.get('X-AppEngine-TaskName', '')
+        for i, delta in enumerate(self.request.get_all('delta')):
+            fields = delta.split(' ')
+            year, category, delta, release = fields[:4]
+            # Tasks enqueued before the checksums were kept have no
+            # ballot, and leave them wrong until the counters are reconciled.
+            checksum = 0
+            if len(fields) > 4 and fields[4] != 'None':
+                checksum = VoteCounter.addHash(0, db.Key(fields[4]),
+                                               category, int(delta))
+            VoteCounter.increment(int(year), db.Key(release), category,
+                                  int(delta), '%s/%d' % (taskName, i),
+                                  checksum)
+        if self.request.get('uncanonicalized'):
+            year, delta = self.request.get('uncanonicalized').split(' ')
+            CanonQueue.increment(int(year), int(delta), taskName + '/canon')
+
+# Deletes the old CounterMarkers; run daily by cron.
+class ExpireCounterMarkersPage(Page):
+    def get(self):
+        CounterMarker.expire()
+
+class ReconcileCountersPage(Page):
+    def post(self, year):
+        poll = Poll.get(year)
+        if not poll:
+            self.response.out.write('No poll for ' + year + '.')
+            return
+        try:
+            drift = poll.reconcileCounters()
+        except CountersBusy, e:
+            self.response.out.write('Not reconciled: %s  Try again once '
+                                    'voting is closed and the counters '
+                                    'are idle.' % e)
+            return
+        self.response.out.write('<pre>\n')
+        for release, category, counted, actual in drift:
+            line = 'Release %d %s: counted %d, actually %d' % (
+                release.id(), category, counted, actual)
+            logging.warning(line)
+            self.response.out.write(line + '\n')
+        self.response.out.write('</pre>\n')
+        self.response.out.write('Corrected the counters; %d had drifted.'
+                                % len(drift))
+
+# Bumps the generations of the artist pages for changed releases.
+class InvalidatePage(Page):
+    def post(self):
+        Generation.bumpReleases([db.Key(r) for r in
+                                 self.request.get_all('release')])
+
+# Deletes the cached pages for old generations.  Enqueued by
+# Generation.bump, and run daily by cron (which uses GET) for the pages
+# made stale by changes to the open poll years.
+class SweepPageCachePage(Page):
+    def post(self):
+        deleted = PageCache.sweep()
+        logging.info('Deleted %d stale cached pages' % deleted)
+
+    get = post
+
+# Upgrades the stored data for a poll one batch at a time, chaining a
+# task for each following batch.
+class UpgradePage(Page):
+    def post(self, year):
+        poll = Poll.get(year)
+        if not poll:
+            self.response.out.write('No poll for ' + year + '.')
+            return
+        cursor = poll.upgrade(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/admin/%d/upgrade' % poll.year,
+                          params={ 'cursor': cursor })
+        self.response.out.write('Upgraded.')
+
+# Links the uncanonicalized votes for a poll that unambiguously name a
+# release, leaving the rest for CanonPage, one batch at a time,
+# chaining a task for each following batch.
+class AutoCanonPage(Page):
+    def post(self, year):
+        poll = Poll.get(year)
+        if not poll:
+            self.response.out.write('No poll for ' + year + '.')
+            return
+        useMB = self.request.get('mb')
+        linked, ambiguous, cursor = poll.autoCanonicalize(
+            bool(useMB), self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/admin/%d/autocanon' % poll.year,
+                          params={ 'cursor': cursor, 'mb': useMB })
+        logging.info('Linked %d votes; %d groups left ambiguous.'
+                     % (linked, len(ambiguous)))
+        self.response.out.write('Linked %d votes in the first batch; '
+                                'the rest are being linked.' % linked)
+
+# Sets the normalized titles of the stored releases one batch at a
+# time, chaining a task for each following batch.
+class UpgradeReleasesPage(Page):
+    def post(self):
+        cursor = Release.upgrade(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(url='/admin/releases/upgrade',
+                          params={ 'cursor': cursor })
+        self.response.out.write('Upgraded.')
+
 class CacheRankedReleasePage(Page):
     def post(self, year, id):
         release = Release.get_by_id(int(id))
@@ -345,6 +682,7 @@ class CanonPage(Page):
             self.response.out.write('No such vote: ' + ballotID + '/' + voteID)
             return
         render = dict(v=vote)
+        mbArtist = None
         title = self.request.get('title', default_value=vote.title)
         render['title'] = title
         mbArtistid = self.request.get('artist.mbid', default_value=None)
@@ -365,27 +703,50 @@ class CanonPage(Page):
                                   r.key() != vote.release.key()]
         else:
             if mbArtistid:
-                artist = mb.Artist(mbArtistid)
-                render['mbArtist'] = artist
-            render['artists'] = [a for a in Artist.gql('WHERE name = :1', name)]
-            render['releases'] = [r for r in
-                                  Release.gql('WHERE title = :1', title)
-                                  if not vote.release or
-                                  r.key() != vote.release.key()]
+                mbArtist = mb.Artist.getAsync(mbArtistid)
+            render['artists'] = self.candidates(
+                Artist.gql('WHERE name = :1', name), 'Artist', name)
+            render['releases'] = prefetch(
+                [r for r in self.candidates(
+                    Release.gql('WHERE title = :1', title), 'Release', title)
+                 if not vote.release or r.key() != vote.release.key()],
+                'artist')
         render['name'] = name
         search = dict(title=title)
         if mbArtistid:
             search['artistid'] = mbArtistid
         else:
             search['artist'] = name
-        rgs = mb.ReleaseGroup.search(**search)
+        # Start the fallback search along with the main one, so that a
+        # miss doesn't cost another round trip.
+        rgs = mb.ReleaseGroup.searchAsync(**search)
+        if mbArtistid:
+            fallback = mb.ReleaseGroup.searchAsync(artistid=mbArtistid)
+        else:
+            fallback = mb.Artist.searchAsync(name=name)
+        if mbArtist:
+            render['mbArtist'] = mbArtist.get_result()
+        rgs = rgs.get_result()
         if rgs:
             render['rgs'] = rgs
         elif mbArtistid:
-            render['rgs'] = mb.ReleaseGroup.search(artistid=mbArtistid)
+            render['rgs'] = fallback.get_result()
         else:
-            render['mbArtists'] = mb.Artist.search(name=name)
+            render['mbArtists'] = fallback.get_result()
         self.render('canon.html', **render)
+        # Cache the fallback's response even if it wasn't needed, so the
+        # request isn't wasted.
+        fallback.cache()
+
+    # Returns a list of the entities matching a name exactly, followed
+    # by the others that NameIndex finds with similar names.
+    @staticmethod
+    def candidates(exact, kind, name):
+        found = list(exact)
+        keys = set(e.key() for e in found)
+        found.extend(e for score, e in NameIndex.search(kind, name)
+                     if e.key() not in keys)
+        return found
 
     def post(self, ballotID, voteID):
         self.catchHTTPError(lambda: self.rawPost(ballotID, voteID))
@@ -412,51 +773,122 @@ class CanonPage(Page):
                 if artisturl:
                     artist.url = artisturl
                 artist.put()
+                NameIndex.update([artist])
             release = Release(artist=artist, title=self.request.get('title'))
             releaseurl = self.request.get('releaseurl', default_value=None)
             if releaseurl:
                 release.url = releaseurl
             release.put()
+            NameIndex.update([release])
             vote.release = release
-        vote.put()
-        next = Vote.gql('WHERE release = :1 ORDER BY artist', None).get()
+        db.run_in_transaction(self.canonicalize, ballotID, voteID,
+                              Vote.release.get_value_for_datastore(vote))
+        Generation.bump(['ballot/' + ballotID])
+        # Vote.year is None until Poll.upgrade reaches the vote.
+        next = CanonQueue.next(vote.ballot.year)
         if next:
             key = next.key()
             self.redirect('../%d/%d' % (key.parent().id(), key.id()))
         else:
             self.redirect('../..')
             
+    # Sets the release of a vote, and updates the vote counters.
+    def canonicalize(self, ballotID, voteID, release):
+        vote = self.getVote(ballotID, voteID)
+        vote.release = release
+        vote.ballot.saveVotes(put=[vote])
+
+# Adds newly stored Artists and Releases to the NameIndex.
+class NameIndexPage(Page):
+    def post(self):
+        NameIndex.add([e for e in db.get(self.request.get_all('key')) if e])
+
+# Rebuilds the NameIndex, in a task.
+class RebuildNameIndexPage(Page):
+    def post(self):
+        if self.request.headers.get('X-AppEngine-QueueName'):
+            NameIndex.rebuild()
+        else:
+            taskqueue.add(url='/admin/index/rebuild')
+            self.response.out.write('Rebuilding the name index.')
+
 class BackupPage(Page):
     def get(self):
-        self.response.headers['Content-Type'] = "text/xml"
-        self.response.out.write('<?xml version="1.0" encoding="UTF-8"?>')
-        self.response.out.write('<chugchanga-poll>')
-        for model in [Globals, Poll, Voter, Ballot, Vote, Release, Artist]:
-            for obj in model.all():
-                self.response.out.write(obj.to_xml())
-        self.response.out.write('</chugchanga-poll>')
-        
+        backups = Backup.all().order('-started').fetch(10)
+        self.render('backup.html', backups=backups)
+    def post(self):
+        Backup.start()
+        self.redirect('backup')
+
+# Exports the next batch of a Backup, in a task.
+class ExportBackupPage(Page):
+    def post(self, id):
+        backup = Backup.get_by_id(int(id))
+        if not backup:
+            self.response.out.write('No such backup: ' + id)
+            return
+        backup.exportBatch()
+
+class BackupChunkPage(Page):
+    def get(self, id, name):
+        chunk = BackupChunk.get_by_key_name(
+            name, parent=db.Key.from_path(Backup.kind(), int(id)))
+        if not chunk:
+            self.error(404)
+            return
+        self.response.headers['Content-Type'] = 'application/x-gzip'
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename=%s.jsonl.gz' % name)
+        self.response.out.write(chunk.content)
 
-application = webapp.WSGIApplication([('/members/', VotePage),
-                                      ('/members/profile/', ProfilePage),
-                                      ('/members/ajax/', AjaxHandler),
-                                      ('/', MainPage),
-                                      ('/([0-9]+)/()', PollPage),
-                                      ('/([0-9]+)/(voters)', PollPage),
-                                      ('/([0-9]+)/(byvotes)', PollPage),
-                                      ('/([0-9]+)/(byartist)', PollPage),
-                                      ('/ballot/([0-9]+)', BallotPage),
-                                      ('/voter/([0-9]+)', VoterPage),
-                                      ('/artist/([0-9]+)', ArtistPage),
-                                      ('/admin/', AdminPage),
-                                      ('/admin/([0-9]+)/', AdminPollPage),
-                                      ('/admin/([0-9]+)/flush', FlushCachePage),
-                                      ('/admin/([0-9]+)/cache/([0-9]+)',
-                                       CacheRankedReleasePage),
-                                      ('/admin/canon/([0-9]+)/([0-9]+)',
-                                       CanonPage),
-                                      ('/admin/backup', BackupPage),
-                                      ], debug=True)
+
+# Shows the recent API call statistics for each route (see rpcstats).
+class RPCStatsPage(Page):
+    def get(self):
+        self.render('stats.html',
+                    routes=rpcstats.aggregates(application.routeNames()),
+                    threshold=rpcstats.repeatThreshold)
+
+routes = [('/members/', VotePage),
+          ('/members/profile/', ProfilePage),
+          ('/members/ajax/', AjaxHandler),
+          ('/members/autosave/', AutosaveHandler),
+          ('/', MainPage),
+          ('/([0-9]+)/()', PollPage),
+          ('/([0-9]+)/(voters)', PollPage),
+          ('/([0-9]+)/(byvotes)', PollPage),
+          ('/([0-9]+)/(byartist)', PollPage),
+          ('/ballot/([0-9]+)', BallotPage),
+          ('/voter/([0-9]+)', VoterPage),
+          ('/artist/([0-9]+)', ArtistPage),
+          ('/admin/', AdminPage),
+          ('/admin/([0-9]+)/', AdminPollPage),
+          ('/admin/([0-9]+)/flush', FlushCachePage),
+          ('/admin/([0-9]+)/upgrade', UpgradePage),
+          ('/admin/([0-9]+)/autocanon', AutoCanonPage),
+          ('/admin/([0-9]+)/reconcile', ReconcileCountersPage),
+          ('/admin/counters', VoteCounterPage),
+          ('/admin/counters/expire', ExpireCounterMarkersPage),
+          ('/admin/invalidate', InvalidatePage),
+          ('/admin/sweep', SweepPageCachePage),
+          ('/admin/([0-9]+)/cache', CacheChunkPage),
+          ('/admin/([0-9]+)/retry', RetryRankJobPage),
+          ('/admin/([0-9]+)/cache/([0-9]+)', CacheRankedReleasePage),
+          ('/admin/canon/([0-9]+)/([0-9]+)', CanonPage),
+          ('/admin/index', NameIndexPage),
+          ('/admin/index/rebuild', RebuildNameIndexPage),
+          ('/admin/releases/upgrade', UpgradeReleasesPage),
+          ('/admin/backup', BackupPage),
+          ('/admin/backup/([0-9]+)/export', ExportBackupPage),
+          ('/admin/backup/([0-9]+)/'
+           '([0-9]+-[A-Za-z]+)\.jsonl\.gz',
+           BackupChunkPage),
+          ('/admin/stats', RPCStatsPage),
+          ]
+
+application = rpcstats.StatsMiddleware(
+    webapp.WSGIApplication(routes, debug=True), routes,
+    unkept=['/members/ajax/', '/members/autosave/'])
 
 def main():
     run_wsgi_app(application)
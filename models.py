@@ -4,17 +4,116 @@
 import os
 os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 
+import base64
 import collections
+import datetime
+import gzip
+import hashlib
 import itertools
+import random
+import StringIO
+from google.appengine.api import memcache
+from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 from google.appengine.api.labs import taskqueue
+from google.appengine.api.taskqueue import Queue, QueueStatistics
+from django.utils import simplejson
 import musicbrainz
 mb = musicbrainz
 
 import time
 import logging
 
+# A read-through cache for values read on nearly every request, such as
+# the open poll years.  It has two tiers: memcache, shared by all
+# instances, and a dict in this instance's memory.  Entries in the
+# local tier expire after a few seconds so that values changed by other
+# instances are seen soon.  Entries in memcache expire after a minute,
+# so that changes made without invalidating them, such as opening a
+# poll from the datastore viewer or remote_api, or a value loaded just
+# before an invalidation and added just after it, are seen eventually.
+# Entities are cached as encoded protocol buffers, so each caller gets
+# its own copy.  Some keys are per voter, so the local tier is pruned
+# of expired entries whenever it fills up.
+class ReadCache(object):
+    namespace = 'ReadCache'
+
+    def __init__(self, ttl=10, memcacheTTL=60, maxLocal=1000):
+        self.ttl = ttl
+        self.memcacheTTL = memcacheTTL
+        self.maxLocal = maxLocal
+        self.local = dict()
+
+    # Returns the cached value for key, calling load to get it on a miss.
+    def get(self, key, load):
+        now = time.time()
+        hit = self.local.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+        value = memcache.get(key, namespace=self.namespace)
+        if value is None:
+            value = load()
+            memcache.add(key, value, time=self.memcacheTTL,
+                         namespace=self.namespace)
+        if key not in self.local and len(self.local) >= self.maxLocal:
+            self.prune(now)
+        self.local[key] = (now + self.ttl, value)
+        return value
+
+    # Removes the expired entries from the local tier, or all of them if
+    # that doesn't free at least half of it, so that pruning stays rare.
+    def prune(self, now):
+        expired = [k for k, hit in self.local.iteritems() if hit[0] <= now]
+        if len(expired) < self.maxLocal // 2:
+            self.local.clear()
+        for k in expired:
+            self.local.pop(k, None)
+
+    # Returns the cached entity for key, calling load to get it on a miss.
+    def getEntity(self, key, load):
+        def loadEncoded():
+            entity = load()
+            if entity:
+                return db.model_to_protobuf(entity).Encode()
+            return ''
+        encoded = self.get(key, loadEncoded)
+        if encoded:
+            return db.model_from_protobuf(encoded)
+
+    # Returns the cached list of entities for key, calling load to get
+    # it on a miss.
+    def getEntities(self, key, load):
+        def loadEncoded():
+            return [db.model_to_protobuf(e).Encode() for e in load()]
+        return [db.model_from_protobuf(e) for e in self.get(key, loadEncoded)]
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.local.pop(key, None)
+        memcache.delete_multi(keys, namespace=self.namespace)
+
+cache = ReadCache()
+
+# Fetches the entities referred to by ReferenceProperty attribute
+# paths, such as 'ballot.voter', of a list of entities.  Each level of
+# each path is fetched with one batch get, and the results are attached
+# to the referring entities, so that later access to those attributes
+# costs nothing.  Returns the entities.
+def prefetch(entities, *paths):
+    for path in paths:
+        level = [e for e in entities if e]
+        for name in path.split('.'):
+            refs = [(e, getattr(type(e), name).get_value_for_datastore(e))
+                    for e in level]
+            keys = list(set(key for e, key in refs if key))
+            fetched = dict((r.key(), r) for r in db.get(keys) if r)
+            for e, key in refs:
+                if key in fetched:
+                    setattr(e, name, fetched[key])
+            level = fetched.values()
+    return entities
+
 # Globals is a singleton class whose instance hold globals values.
 class Globals(db.Model):
     # Users must enter the secret word before they become Voters.
@@ -22,10 +121,165 @@ class Globals(db.Model):
 
     @classmethod
     def checkSecretWord(cls, word):
-        globals = cls.all().get()
+        globals = cls.singleton()
         secret = globals.secretWord if globals else None
         return word == secret
 
+    # Returns the Globals instance, or None.
+    @classmethod
+    def singleton(cls):
+        return cache.getEntity('Globals', lambda: cls.all().get())
+
+    def put(self):
+        key = db.Model.put(self)
+        cache.invalidate('Globals')
+        return key
+
+    def delete(self):
+        db.Model.delete(self)
+        cache.invalidate('Globals')
+
+# A PageCache is a rendered page, stored gzip-compressed, with a
+# memcache copy in front of it.  Changing the key name is the only way
+# to change the page, so its ETag is a hash of the content.
+class PageCache(db.Model):
+    content = db.BlobProperty()     # gzip-compressed
+    etag = db.StringProperty()
+    modified = db.DateTimeProperty()
+
+    # Returns the cached page with the given key name, or None.
+    @classmethod
+    def fetch(cls, keyName):
+        page = memcache.get(keyName, namespace=cls.kind())
+        if page is None:
+            page = cls.get_by_key_name(keyName)
+            if page:
+                memcache.add(keyName, page, namespace=cls.kind())
+        return page
+
+    # Compresses and caches a rendered page, given as a string or an
+    # iterable of strings, and returns the PageCache.  The chunks are
+    # compressed as they arrive, so only the compressed page is held
+    # in memory.
+    @classmethod
+    def store(cls, keyName, rendered):
+        if isinstance(rendered, basestring):
+            rendered = [rendered]
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        sha1 = hashlib.sha1()
+        for chunk in rendered:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            f.write(chunk)
+            sha1.update(chunk)
+        f.close()
+        page = cls(key_name=keyName, content=db.Blob(buf.getvalue()),
+                   etag=sha1.hexdigest(),
+                   modified=datetime.datetime.utcnow().replace(microsecond=0))
+        page.put()
+        memcache.set(keyName, page, namespace=cls.kind())
+        return page
+
+    # Deletes the cached pages with the given key names.
+    @classmethod
+    def evict(cls, keyNames):
+        memcache.delete_multi(keyNames, namespace=cls.kind())
+        db.delete([db.Key.from_path(cls.kind(), k) for k in keyNames])
+
+    # Returns the key name for a page showing the data of the named
+    # generations (see Generation), a global generation and the open
+    # poll years, so that it changes whenever any of them change.
+    @staticmethod
+    def generationKey(names):
+        generations = Generation.current(names + ['global'])
+        return '%s/%s/%s' % ('+'.join(names),
+                             '.'.join(str(g) for g in generations),
+                             ','.join(str(y) for y in Poll.openYears()))
+
+    # Deletes the pages cached under generationKey that are no longer
+    # current.  Returns the number deleted.
+    @classmethod
+    def sweep(cls, batchSize=500):
+        deleted = 0
+        q = cls.all(keys_only=True)
+        while True:
+            keys = q.fetch(batchSize)
+            stale = []
+            for key in keys:
+                names, generations, years = (key.name().rsplit('/', 2)
+                                             + ['', ''])[:3]
+                # The poll pages have their own generation (see Poll.flush).
+                if not generations.replace('.', '').isdigit():
+                    continue
+                if key.name() != cls.generationKey(names.split('+')):
+                    stale.append(key)
+            cls.evict([k.name() for k in stale])
+            deleted += len(stale)
+            if len(keys) < batchSize:
+                return deleted
+            q.with_cursor(q.cursor())
+
+    # Yields the uncompressed page in chunks.
+    def text(self, chunkSize=65536):
+        f = gzip.GzipFile(fileobj=StringIO.StringIO(self.content))
+        chunk = f.read(chunkSize)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunkSize)
+
+# A Generation numbers the versions of the data shown on a cached
+# page, such as an artist's page.  Bumping it makes the cached copies
+# obsolete, since their key names include the generations.
+class Generation(db.Model):
+    value = db.IntegerProperty(default=0)
+
+    # The seconds a value stays in memcache, which bounds how long a
+    # value loaded just before a bump and added just after it is used.
+    ttl = 600
+
+    # Returns a list of the current values of the named generations.
+    @classmethod
+    def current(cls, names):
+        found = memcache.get_multi(names, namespace=cls.kind())
+        missing = [n for n in names if n not in found]
+        if missing:
+            keys = [db.Key.from_path(cls.kind(), n) for n in missing]
+            loaded = dict()
+            for name, g in zip(missing, db.get(keys)):
+                loaded[name] = g.value if g else 0
+            memcache.add_multi(loaded, time=cls.ttl, namespace=cls.kind())
+            found.update(loaded)
+        return [found[n] for n in names]
+
+    # Bumps the named generations, and enqueues a task to delete the
+    # pages cached under the old ones.  Must not be run in a
+    # transaction.
+    @classmethod
+    def bump(cls, names):
+        def txn(name):
+            g = cls.get_by_key_name(name) or cls(key_name=name)
+            g.value += 1
+            g.put()
+        for name in set(names):
+            db.run_in_transaction(txn, name)
+        memcache.delete_multi(list(set(names)), namespace=cls.kind())
+        # One sweep per ttl is enough, however many bumps there are.
+        try:
+            taskqueue.add(url='/admin/sweep', countdown=cls.ttl,
+                          name='sweep-%d' % (time.time() // cls.ttl))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    # Bumps the generations of the pages of the artists of the given
+    # releases.
+    @classmethod
+    def bumpReleases(cls, releases):
+        artists = set(Release.artist.get_value_for_datastore(r)
+                      for r in db.get(releases) if r)
+        cls.bump(['artist/%d' % a.id() for a in artists])
+
 class Poll(db.Model):
     year = db.IntegerProperty(required=True)
     votingIsOpen = db.BooleanProperty(default=True)
@@ -33,77 +287,262 @@ class Poll(db.Model):
     numVotedReleases = db.IntegerProperty()
     numUniqueVotes = db.IntegerProperty()
     numReleases = db.IntegerProperty()
-    # Cached pages:
-    results = db.TextProperty()
-    voters = db.TextProperty()
-    byvotes = db.TextProperty()
-    byartist = db.TextProperty()
+    # Bumped to flush the pages cached in PageCache.
+    generation = db.IntegerProperty(default=0)
+
+    pages = ['results', 'voters', 'byvotes', 'byartist']
 
     # Flush the cached pages.
     def flush(self):
-        self.results = None
-        self.voters = None
-        self.byvotes = None
-        self.byartist = None
-        self.put()
+        old = [self.pageKey(name) for name in self.pages]
+        def txn():
+            poll = db.get(self.key())
+            poll.generation += 1
+            poll.put()
+            return poll.generation
+        self.generation = db.run_in_transaction(txn)
+        Poll.invalidate(self.year)
+        PageCache.evict(old)
+
+    # Returns the PageCache key name for one of the poll's pages.
+    def pageKey(self, name):
+        return '%d/%s/%d' % (self.year, name, self.generation)
+
+    # Returns the URL of one of the poll's pages.
+    def url(self, name):
+        return '/%d/%s' % (self.year, '' if name == 'results' else name)
 
     # Returns the years (ints) whose polls are currently open for voting.
     @classmethod
     def openYears(cls):
-        return [p.year for p in
-                cls.gql('WHERE votingIsOpen = True ORDER BY year')]
+        return list(cache.get('openYears', lambda: [
+                    p.year for p in
+                    cls.gql('WHERE votingIsOpen = True ORDER BY year')]))
+
+    # Returns the years (ints) whose polls are closed.
+    @classmethod
+    def closedYears(cls):
+        return list(cache.get('closedYears', lambda: [
+                    p.year for p in cls.gql('WHERE votingIsOpen = False')]))
 
     # Returns the Poll object for a given year.
     @classmethod
     def get(cls, year):
-        return cls.gql('WHERE year = :1', int(year)).get()
+        year = int(year)
+        return cache.getEntity('Poll/%d' % year, lambda:
+                               cls.gql('WHERE year = :1', year).get())
+
+    # Drops the cached copies of a year's Poll and the open and closed
+    # years.
+    @staticmethod
+    def invalidate(year):
+        cache.invalidate('Poll/%d' % year, 'openYears', 'closedYears')
+
+    def put(self):
+        key = db.Model.put(self)
+        Poll.invalidate(self.year)
+        return key
+
+    def delete(self):
+        db.Model.delete(self)
+        Poll.invalidate(self.year)
 
     # Returns a Query for all ballots for this poll.
     def ballots(self):
         return Ballot.gql('WHERE year = :1', self.year)
 
-    # Returns an iterator for all non-empty ballots for this poll.
+    # Returns a list of all non-empty ballots for this poll.  Ballots
+    # whose vote count is still unknown (see Poll.upgrade) are checked
+    # by counting their votes.
     def nonEmptyBallots(self):
-        return itertools.ifilterfalse(Ballot.isEmpty, self.ballots())
+        q = Ballot.gql('WHERE year = :1 AND voteCount > 0', self.year)
+        unknown = Ballot.gql('WHERE year = :1 AND voteCount = :2',
+                             self.year, None)
+        return list(q) + [b for b in unknown if not b.isEmpty()]
 
     # Returns a list of all non-empty ballots, sorted by voter name.
     def nonEmptyBallotsSorted(self):
         return sorted(self.nonEmptyBallots(), key=Ballot.name)
 
-    # Returns a list of tuples of releases and dicts mapping categories to
-    # lists of votes.  Also sets statistical properties on the Poll object.
+    # Returns a tuple of a dict mapping release keys to lists of vote
+    # counts, one per category (in the order of Ballot.categories),
+    # the number of voters, and a dict mapping release keys to the
+    # checksums of their votes (see VoteCounter.voteHash), tallied from
+    # scratch from the votes.
+    # All of the year's votes are streamed in large batches as
+    # projections, so only raw reference keys are loaded, never the
+    # Release entities or the vote comments.  That query is eventually
+    # consistent, so if consistent is true each ballot's votes are
+    # read with an ancestor query instead, a batch of ballots at a time.
+    def tallyVotes(self, consistent=False):
+        count = dict()
+        checksums = collections.defaultdict(int)
+        numVoters = 0
+        def countBallot(ballot, votes):
+            for release, category in Ballot.countedReleases(votes).items():
+                if release not in count:
+                    count[release] = [0] * len(Ballot.categories)
+                count[release][Ballot.categories.index(category)] += 1
+                checksums[release] = VoteCounter.addHash(
+                    checksums[release], ballot, category, 1)
+        if consistent:
+            keys = list(Ballot.all(keys_only=True).filter('year =', self.year))
+            for i in range(0, len(keys), 50):
+                batch = keys[i:i+50]
+                # Start all the queries before waiting on any of them.
+                queries = [Vote.all().ancestor(k).run(batch_size=100)
+                           for k in batch]
+                for ballot, q in zip(batch, queries):
+                    votes = list(q)
+                    if votes:
+                        countBallot(ballot, votes)
+                        numVoters += 1
+            return count, numVoters, dict(checksums)
+        ballot = None
+        votes = []
+        q = db.Query(Vote, projection=('ballot', 'category', 'release'))
+        q.filter('year =', self.year).order('ballot')
+        for v in q.run(batch_size=1000):
+            b = Vote.ballot.get_value_for_datastore(v)
+            if b != ballot:
+                countBallot(ballot, votes)
+                numVoters += 1
+                ballot = b
+                votes = []
+            votes.append(v)
+        countBallot(ballot, votes)
+        return count, numVoters, dict(checksums)
+
+    # Returns the number of ballots for this poll with at least one
+    # vote.
+    def countVoters(self):
+        q = Ballot.all(keys_only=True).filter('year =', self.year)
+        unknown = Ballot.gql('WHERE year = :1 AND voteCount = :2',
+                             self.year, None)
+        return (q.filter('voteCount >', 0).count(limit=None) +
+                len([b for b in unknown if not b.isEmpty()]))
+
+    # Returns a pair of dicts mapping release keys to lists of vote
+    # counts, one per category, and to the checksums of their votes, as
+    # read from the vote counters.  Also sets statistical properties on
+    # the Poll object.
     def countVotes(self):
-        count = collections.defaultdict(lambda: collections.defaultdict(list))
-        for b in self.ballots():
-            votes = Vote.gql('WHERE ballot = :1 AND release != NULL', b)
-            releases = set()
-            for v in votes:
-                # Ignore multiple votes on the same ballot for the
-                # same release!
-                if v.release not in releases:
-                    releases.add(v.release)
-                    count[v.release][v.category].append(v)
-        self.numVoters = len(list(self.nonEmptyBallots()))
-        self.numVotedReleases = len([v for v in count.values()
-                                     if v['favorite']])
-        self.numUniqueVotes = len([v for v in count.values()
-                                   if len(v['favorite']) == 1])
+        count, checksums = VoteCounter.sums(self.year)
+        if not count:
+            # There are no counters until the votes are first
+            # reconciled, so count the votes themselves.
+            count, numVoters, checksums = self.tallyVotes()
+        self.numVoters = self.countVoters()
+        self.numVotedReleases = len([c for c in count.values() if c[0]])
+        self.numUniqueVotes = len([c for c in count.values() if c[0] == 1])
         self.numReleases = len(count)
         self.put()
-        return count.items()
+        return count, checksums
+
+    # Returns a Query for the votes in this poll that haven't been
+    # linked to a release, in normalized artist order.
+    def uncanonicalizedVotes(self):
+        return CanonQueue.query(self.year)
+
+    # Links each group of a batch of uncanonicalized votes, starting at
+    # the given query cursor, that names a single release unambiguously
+    # to that release, looking in the cached MusicBrainz search results
+    # too if useMB is true.  Each ballot's votes are linked in one
+    # transaction.  Returns a tuple of the number of votes linked, a
+    # list of the groups left ambiguous, and the cursor for the next
+    # batch, or None when all the votes have been seen.
+    def autoCanonicalize(self, useMB=False, cursor=None, batchSize=100):
+        q = self.uncanonicalizedVotes()
+        if cursor:
+            q.with_cursor(cursor)
+        batch = q.fetch(batchSize)
+        cursor = q.cursor() if len(batch) == batchSize else None
+        links = collections.defaultdict(list)
+        ambiguous = []
+        for votes in Vote.groups(batch):
+            release = Release.match(votes, useMB)
+            if release:
+                for v in votes:
+                    links[v.key().parent()].append((v.key(), release))
+            else:
+                ambiguous.append(votes)
+        def link(ballotKey, releases):
+            ballot = db.get(ballotKey)
+            votes = db.get(releases.keys())
+            put = []
+            for v in votes:
+                if v and not Vote.release.get_value_for_datastore(v):
+                    v.release = releases[v.key()]
+                    put.append(v)
+            if put:
+                ballot.saveVotes(put=put)
+            return len(put)
+        linked = 0
+        for ballotKey, pairs in links.items():
+            linked += db.run_in_transaction(link, ballotKey, dict(pairs))
+        Generation.bump(['ballot/%d' % k.id() for k in links])
+        return linked, ambiguous, cursor
+
+    # Corrects the vote counters for this poll to match the votes (see
+    # VoteCounter.reconcile).  Returns a list of (release key, category,
+    # counted, actual) tuples for the counters that had drifted from
+    # the votes.  Raises CountersBusy unless voting is closed and no
+    # counter tasks are pending, since a change whose task is still
+    # pending would be counted twice: once in the tally and again when
+    # its task runs.
+    def reconcileCounters(self):
+        if self.votingIsOpen:
+            raise CountersBusy('Voting is still open.')
+        VoteCounter.checkIdle()
+        before = VoteCounter.sums(self.year)
+        count, numVoters, checksums = self.tallyVotes(consistent=True)
+        after = VoteCounter.sums(self.year)
+        VoteCounter.checkIdle()
+        drift = VoteCounter.reconcile(self.year, count, checksums,
+                                      before, after)
+        CanonQueue.recount(self.year)
+        return drift
+
+    # Upgrades a batch of this poll's ballots, starting at the given
+    # query cursor, for data stored before Vote had a year and a
+    # sortartist or Ballot had vote counts.  Returns the cursor for the
+    # next batch, or None when all ballots have been upgraded.
+    def upgrade(self, cursor=None, batchSize=20):
+        q = self.ballots()
+        if cursor:
+            q.with_cursor(cursor)
+        ballots = q.fetch(batchSize)
+        entities = []
+        for b in ballots:
+            votes = list(b.vote_set)
+            for v in votes:
+                sortartist = mb.normalizeName(v.artist)
+                if v.year != self.year or v.sortartist != sortartist:
+                    v.year = self.year
+                    v.sortartist = sortartist
+                    entities.append(v)
+            b.setVoteCounts(votes)
+            entities.append(b)
+        db.put(entities)
+        if len(ballots) < batchSize:
+            return None
+        return q.cursor()
 
     def releaseVotes(self, release, category):
         return [v for v in Vote.gql('WHERE release = :1 AND category = :2',
                                     release, category)
                 if v.ballot.year == self.year]
 
+    # Returns a list of new RankedReleases for this poll, in rank order,
+    # with the checksums of the votes they should show.
     def rankedReleases(self):
         logging.info('Ranking releases for %d' % self.year)
         def key(item):
-            return len(item[1]['favorite']), len(item[1]['honorable'])
+            return item[1][0], item[1][1]
         rank = 1
         t1 = time.time()
-        votes = self.countVotes()
+        count, checksums = self.countVotes()
+        votes = count.items()
         t2 = time.time()
         votes.sort(key=key, reverse=True)
         t3 = time.time()
@@ -115,7 +554,9 @@ class Poll(db.Model):
             nextRank = rank
             for item in g:
                 r, v = item
-                rr = RankedRelease(year=self.year, rank=rank, release=r)
+                rr = RankedRelease(key_name=RankedRelease.keyName(self.year, r),
+                                   year=self.year, rank=rank, release=r,
+                                   checksum=checksums.get(r, 0))
                 rrs.append(rr)
                 nextRank += 1
             rank = nextRank
@@ -123,23 +564,46 @@ class Poll(db.Model):
         logging.info('Time to rank: %f' % (t5-t4))
         return rrs
 
-    def rankReleases(self):
+    # Ranks the releases again and updates the stored RankedReleases to
+    # match, comparing their ranks and vote checksums with a projection
+    # query.  Only the rows whose rank or votes changed are stored,
+    # keeping their HTML, and only the new rows and those whose votes
+    # changed are rendered again, by a RankJob; the releases no longer
+    # ranked are deleted.  If full is true, every row is rendered again, which is
+    # needed after changes to the voters, comments or releases shown.
+    def rankReleases(self, full=False):
         rrs = self.rankedReleases()
         t5 = time.time()
-        q = db.GqlQuery('SELECT __key__ FROM RankedRelease WHERE year = :1',
-                        self.year)
-        db.delete(q)
+        q = db.Query(RankedRelease, projection=('rank', 'checksum'))
+        stored = dict((rr.key(), (rr.rank, rr.checksum))
+                      for rr in q.filter('year =', self.year)
+                      .run(batch_size=1000))
+        keys = db.GqlQuery('SELECT __key__ FROM RankedRelease '
+                           'WHERE year = :1', self.year)
+        ranked = set(rr.key() for rr in rrs)
+        dropped = [k for k in keys if k not in ranked]
+        render = [rr for rr in rrs if full or
+                  stored.get(rr.key(), (None, None))[1] != rr.checksum]
+        moved = [rr for rr in rrs if rr.key() in stored and
+                 stored[rr.key()][0] != rr.rank]
+        # Update the stored rows in place, keeping their HTML until it is
+        # rendered again.  The checksum is set when it is.
+        changed = dict((rr.key(), rr) for rr in render + moved)
+        for old in db.get(changed.keys()):
+            if old:
+                old.rank = changed[old.key()].rank
+                changed[old.key()] = old
+        render = [changed[rr.key()] for rr in render]
+        for rr in render:
+            rr.checksum = None
+        db.delete(dropped)
+        db.put(changed.values())
         t6 = time.time()
-        logging.info('Time to delete: %f' % (t6-t5))
-        db.put(rrs)
+        logging.info('Time to store %d and delete %d of %d: %f' %
+                     (len(changed), len(dropped), len(rrs), t6-t5))
+        RankJob.start(self.year, render)
         t7 = time.time()
-        logging.info('Time to put: %f' % (t7-t6))
-        for rr in rrs:
-            taskqueue.add(url='/admin/%d/cache/%d' % (self.year,
-                                                      rr.release.key().id()))
-        taskqueue.add(url='/admin/%d/flush' % self.year, countdown=len(rrs))
-        t8 = time.time()
-        logging.info('Time to add tasks: %f' % (t8-t7))
+        logging.info('Time to add tasks for %d: %f' % (len(render), t7-t6))
 
     def byVotes(self):
         return RankedRelease.gql('WHERE year = :1 ORDER BY rank, sortname, title',
@@ -149,6 +613,19 @@ class Poll(db.Model):
         return RankedRelease.gql('WHERE year = :1 ORDER BY sortname, rank, title',
                                  self.year)
 
+    # Yields the cached HTML of the ranked releases returned by a query
+    # from byVotes or byArtist, fetching them a batch at a time with a
+    # query cursor.
+    def rankedHTML(self, q, batchSize=200):
+        while True:
+            rrs = q.fetch(batchSize)
+            for rr in rrs:
+                yield (rr.html or '').replace(RankedRelease.rankMarker,
+                                              str(rr.rank))
+            if len(rrs) < batchSize:
+                return
+            q.with_cursor(q.cursor())
+
     def top20andTies(self):
         q = RankedRelease.gql('WHERE year = :1 AND rank < :2 ' +
                               'ORDER BY rank, sortname, title',
@@ -166,12 +643,18 @@ class Voter(db.Model):
     wantsPlain = db.BooleanProperty() # voter prefers plain HTML to Javascript
 
     # A list of the voter's ballots which are not anonymous, empty, or
-    # for a still-open year.
+    # for a still-open year.  Ballots can only change while their poll
+    # is open, so the list is cached until another poll closes.
     def publicBallots(self):
-        return [b for b in
-                Ballot.gql('WHERE voter = :1 AND anonymous = FALSE ' +
-                           'ORDER BY year DESC', self)
-                if not b.isEmpty() and not Poll.get(b.year).votingIsOpen]
+        closed = Poll.closedYears()
+        def load():
+            return [b for b in
+                    Ballot.gql('WHERE voter = :1 AND anonymous = FALSE ' +
+                               'ORDER BY year DESC', self)
+                    if b.year in closed and not b.isEmpty()]
+        key = 'publicBallots/%d/%s' % (self.key().id(),
+                                       ','.join(str(y) for y in closed))
+        return cache.getEntities(key, load)
 
 class Ballot(db.Model):
     voter = db.ReferenceProperty(Voter, required=True)
@@ -181,6 +664,14 @@ class Ballot(db.Model):
     postamble = db.TextProperty(default='')
     honorable = db.IntegerProperty(default=0)
     notable = db.IntegerProperty(default=0)
+    # The numbers of votes stored on the ballot, in total and by
+    # category, kept up to date by saveVotes.  None until the ballot's
+    # votes are first saved or upgraded (see Poll.upgrade).
+    voteCount = db.IntegerProperty()
+    favoriteCount = db.IntegerProperty()
+    honorableCount = db.IntegerProperty()
+    notableCount = db.IntegerProperty()
+    uncanonicalizedCount = db.IntegerProperty() # votes with no release
 
     def name(self):
         if self.anonymous:
@@ -189,19 +680,119 @@ class Ballot(db.Model):
 
     categories = ['favorite', 'honorable', 'notable']
 
+    # Returns a dict mapping the release keys of the given votes, which
+    # must all be from the same ballot, to the category in which each
+    # release is counted.  Votes without a release are ignored.  A
+    # release voted for more than once on the same ballot is only
+    # counted once, in its highest category.
+    @staticmethod
+    def countedReleases(votes):
+        counted = dict()
+        for v in votes:
+            release = Vote.release.get_value_for_datastore(v)
+            if not release:
+                continue
+            category = counted.get(release)
+            if (not category or Ballot.categories.index(v.category) <
+                Ballot.categories.index(category)):
+                counted[release] = v.category
+        return counted
+
+    # Stores the given votes and deletes the given old votes, all of
+    # which must be on this ballot, and updates the ballot's vote
+    # counts and the vote counters for any change in the releases
+    # counted by the ballot.  If given, stored must be all the ballot's
+    # votes as loaded in this transaction, and before and
+    # uncanonicalized must be their counted releases and number without
+    # a release as loaded (see countedReleases and
+    # countUncanonicalized); they may be left out if the loaded votes'
+    # releases and categories have not been changed.  If putBallot is
+    # true, the ballot is stored along with the votes even if its
+    # counts haven't changed.  Must be run in a transaction, with the
+    # ballot loaded in it.
+    def saveVotes(self, put=[], delete=[], stored=None, before=None,
+                  uncanonicalized=None, putBallot=False):
+        if stored is None:
+            stored = Vote.all().ancestor(self)
+        stored = dict((v.key(), v) for v in stored)
+        if before is None:
+            before = Ballot.countedReleases(stored.values())
+        if uncanonicalized is None:
+            uncanonicalized = Ballot.countUncanonicalized(stored.values())
+        db.delete(delete)
+        for v in delete:
+            stored.pop(v.key(), None)
+        counts = self.voteCounts()
+        storedCount = self.uncanonicalizedCount
+        entities = list(put)
+        for v in put:
+            v.sortartist = mb.normalizeName(v.artist)
+            if v.is_saved():
+                stored[v.key()] = v
+        self.setVoteCounts(stored.values() + [v for v in put
+                                              if not v.is_saved()])
+        if (putBallot or self.voteCounts() != counts or
+            self.uncanonicalizedCount != storedCount):
+            entities.append(self)
+        db.put(entities)
+        for v in put:
+            stored[v.key()] = v
+        after = Ballot.countedReleases(stored.values())
+        VoteCounter.update(self.year, before, after,
+                           self.uncanonicalizedCount - uncanonicalized,
+                           self.key())
+        # The artist pages show the votes for each release.
+        releases = set(Vote.release.get_value_for_datastore(v)
+                       for v in put + delete)
+        releases.update(r for r in set(before) | set(after)
+                        if before.get(r) != after.get(r))
+        releases.discard(None)
+        if releases:
+            taskqueue.add(url='/admin/invalidate',
+                          params={ 'release': [str(r) for r in releases] },
+                          transactional=db.is_in_transaction())
+
+    # Returns a list of the ballot's stored vote counts, one per
+    # category.
+    def voteCounts(self):
+        return [self.favoriteCount, self.honorableCount, self.notableCount]
+
+    # Sets the ballot's vote counts from a list of all its votes.
+    def setVoteCounts(self, votes):
+        counts = dict((c, 0) for c in self.categories)
+        for v in votes:
+            counts[v.category] += 1
+        self.favoriteCount = counts['favorite']
+        self.honorableCount = counts['honorable']
+        self.notableCount = counts['notable']
+        self.voteCount = len(votes)
+        self.uncanonicalizedCount = Ballot.countUncanonicalized(votes)
+
+    # Returns the number of the given votes without a release.
+    @staticmethod
+    def countUncanonicalized(votes):
+        return len([v for v in votes
+                    if not Vote.release.get_value_for_datastore(v)])
+
     # Returns True iff the ballot has no votes.
     def isEmpty(self):
-        return self.vote_set.count() == 0
+        if self.voteCount is None:
+            return self.vote_set.count() == 0
+        return self.voteCount == 0
 
     # Returns the ballot's vote with the given category and rank.  If
     # there is no such vote, a new Vote is returned.  The new Vote is
     # *not* stored in the database.
     def getVote(self, category, rank):
-        vote = Vote.gql('WHERE ballot = :1 AND category = :2 AND rank = :3',
+        vote = Vote.gql('WHERE ANCESTOR IS :1 AND category = :2 AND rank = :3',
                         self, category, rank).get()
         if vote:
             return vote
-        return Vote(parent=self, ballot=self,
+        return self.newVote(category, rank)
+
+    # Returns a new, unstored Vote with the given category and rank.
+    def newVote(self, category, rank):
+        return Vote(parent=self, ballot=self, year=self.year,
                     category=category, rank=rank)
 
     # Returns the highest rank of the ballot's votes in the given
@@ -220,14 +811,28 @@ class Ballot(db.Model):
         return Vote.gql('WHERE ballot = :1 AND category = :2 ORDER BY rank',
                         self, category)
 
-    # Returns a dict mapping categories to iterables of the ballot's
-    # votes for that category.
+    # Returns a dict mapping categories to lists of the ballot's votes
+    # for that category, in ascending order by rank.  All the votes are
+    # fetched with one query.
     def getVotesDict(self):
         votes = dict()
         for category in self.categories:
-            votes[category] = self.getVotes(category)
+            votes[category] = []
+        for vote in Vote.all().ancestor(self):
+            votes.setdefault(vote.category, []).append(vote)
+        for category in votes:
+            votes[category].sort(key=lambda v: v.rank)
         return votes
 
+    # Returns a dict mapping (category, rank) pairs to the ballot's
+    # votes, fetched with one query.
+    def getVoteIndex(self):
+        index = dict()
+        for votes in self.getVotesDict().values():
+            for vote in votes:
+                index.setdefault((vote.category, vote.rank), vote)
+        return index
+
 class Artist(db.Model):
     name = db.StringProperty(required=True)
     sortname = db.StringProperty(required=True)
@@ -237,23 +842,60 @@ class Artist(db.Model):
     def releases(self):
         return Release.gql('WHERE artist = :1 ORDER BY title', self)
 
+    # Returns a list of pairs of the artist's releases and their sorted
+    # votes (see Release.votes).  The votes' queries run concurrently,
+    # and their ballots and voters are fetched together.
+    def releaseVotes(self):
+        releases = list(self.releases())
+        queries = [r.vote_set.run(batch_size=100) for r in releases]
+        votes = [list(q) for q in queries]
+        prefetch([v for vs in votes for v in vs], 'ballot.voter')
+        return [(r, Release.sortVotes(vs)) for r, vs in zip(releases, votes)]
+
     @staticmethod
     def get(mbid):
         artist = Artist.gql('WHERE mbid = :1', mbid).get()
         if not artist:
-            mbArtist = mb.Artist(mbid)
-            artist = Artist(name=mbArtist.name,
-                            sortname=mbArtist.sortname.lower(),
-                            mbid=mbid)
-            artist.put()
+            artist = Artist.create(mb.Artist(mbid))
+        return artist
+
+    # Creates and stores an Artist for a MusicBrainz artist.
+    @staticmethod
+    def create(mbArtist):
+        artist = Artist(name=mbArtist.name,
+                        sortname=(mbArtist.sortname or mbArtist.name).lower(),
+                        mbid=mbArtist.id)
+        artist.put()
+        NameIndex.update([artist])
         return artist
 
 class Release(db.Model):
     artist = db.ReferenceProperty(Artist, required=True)
     title = db.StringProperty(required=True)
+    normtitle = db.StringProperty() # normalized title, set by put
     mbid = db.StringProperty()
     url = db.LinkProperty()
 
+    def put(self):
+        self.normtitle = mb.normalizeName(self.title)
+        return db.Model.put(self)
+
+    # Sets the normalized titles of a batch of releases stored before
+    # Release had them, starting at the given query cursor.  Returns
+    # the cursor for the next batch, or None when all are done.
+    @classmethod
+    def upgrade(cls, cursor=None, batchSize=200):
+        q = cls.all()
+        if cursor:
+            q.with_cursor(cursor)
+        releases = q.fetch(batchSize)
+        for r in releases:
+            r.normtitle = mb.normalizeName(r.title)
+        db.put(releases)
+        if len(releases) < batchSize:
+            return None
+        return q.cursor()
+
     def markup(self):
         return '<strong>%s</strong>, <cite>%s</cite>' % (self.artist.name,
                                                          self.title)
@@ -270,7 +912,13 @@ class Release(db.Model):
         return self.key() == r.key()
 
     def votes(self):
-        votes = list(self.vote_set)
+        return Release.sortVotes(list(self.vote_set))
+
+    # Sorts a list of votes by year, category and voter name, after
+    # prefetching their ballots and voters.  Returns the list.
+    @staticmethod
+    def sortVotes(votes):
+        prefetch(votes, 'ballot.voter')
         votes.sort(key=lambda v: (v.ballot.year, v.category, v.ballot.name()))
         return votes
 
@@ -278,19 +926,165 @@ class Release(db.Model):
     def get(mbid):
         release = Release.gql('WHERE mbid = :1', mbid).get()
         if not release:
-            mbRelease = mb.ReleaseGroup(mbid)
-            release = Release(artist=Artist.get(mbRelease.artist.id),
-                              title=mbRelease.title,
-                              mbid=mbRelease.id)
-            release.put()
+            release = Release.create(mb.ReleaseGroup(mbid))
+        return release
+
+    # Creates and stores a Release for a MusicBrainz release group,
+    # taking its artist from the release group.
+    @staticmethod
+    def create(mbRelease):
+        artist = Artist.gql('WHERE mbid = :1', mbRelease.artist.id).get()
+        release = Release(artist=artist or Artist.create(mbRelease.artist),
+                          title=mbRelease.title,
+                          mbid=mbRelease.id)
+        release.put()
+        NameIndex.update([release])
         return release
 
+    # Returns the key of the one release that a group of votes with the
+    # same normalized artist and title (see Vote.canonKey) could name,
+    # or None if there is no such release or more than one.  Releases
+    # are looked up by normalized title and then by MusicBrainz release
+    # group, in the cached search results only, if useMB is true.
+    @staticmethod
+    def match(votes, useMB=False):
+        artist, title = Vote.canonKey(votes[0])
+        if not artist or not title:
+            return None
+        releases = Release.gql('WHERE normtitle = :1', title).fetch(100)
+        releases.extend(r for score, r in NameIndex.search('Release', title))
+        prefetch(releases, 'artist')
+        keys = set(r.key() for r in releases
+                   if mb.normalizeName(r.title) == title
+                   and mb.normalizeName(r.artist.name) == artist)
+        if len(keys) == 1:
+            return keys.pop()
+        if keys or not useMB:
+            return None
+        # Search as CanonPage would for the group's most common spelling.
+        (name, text), n = collections.Counter(
+            (v.artist, v.title) for v in votes).most_common(1)[0]
+        rgs = mb.ReleaseGroup.searchCached(title=text, artist=name) or []
+        rgs = dict((rg.id, rg) for rg in rgs
+                   if mb.normalizeName(rg.title) == title
+                   and mb.normalizeName(rg.artist.name) == artist)
+        if len(rgs) != 1:
+            return None
+        id, rg = rgs.popitem()
+        release = Release.gql('WHERE mbid = :1', id).get()
+        return (release or Release.create(rg)).key()
+
+# A NameIndex lists the Artists or Releases whose normalized names (see
+# mb.normalizeName) contain a trigram, for finding names that are spelled a
+# little differently.  It is keyed by kind and trigram.
+class NameIndex(db.Model):
+    keys = db.ListProperty(db.Key, indexed=False)
+
+    # The name properties indexed for each kind.
+    fields = { 'Artist': ('name', 'sortname'), 'Release': ('title',) }
+
+    # The most trigrams updated in one transaction, the limit on entity
+    # groups in a cross-group transaction.
+    batchSize = 25
+
+    @staticmethod
+    def trigrams(name):
+        name = ' %s ' % mb.normalizeName(name or '')
+        return set(name[i:i+3] for i in range(len(name) - 2))
+
+    @staticmethod
+    def keyName(kind, trigram):
+        return '%s/%s' % (kind, trigram)
+
+    # Returns a dict mapping key names to sets of the keys of the
+    # entities whose names contain that trigram.
+    @classmethod
+    def entries(cls, entities):
+        entries = collections.defaultdict(set)
+        for e in entities:
+            for field in cls.fields[e.kind()]:
+                for t in cls.trigrams(getattr(e, field)):
+                    entries[cls.keyName(e.kind(), t)].add(e.key())
+        return entries
+
+    # Adds entities to the index, a batch of trigrams per transaction.
+    @classmethod
+    def add(cls, entities):
+        def txn(batch):
+            indexes = cls.get_by_key_name([k for k, keys in batch])
+            put = []
+            for index, (keyName, keys) in zip(indexes, batch):
+                index = index or cls(key_name=keyName)
+                keys = keys - set(index.keys)
+                if keys:
+                    index.keys.extend(keys)
+                    put.append(index)
+            db.put(put)
+        entries = cls.entries(entities).items()
+        options = db.create_transaction_options(xg=True)
+        for i in range(0, len(entries), cls.batchSize):
+            db.run_in_transaction_options(options, txn,
+                                          entries[i:i+cls.batchSize])
+
+    # Enqueues a task to add newly stored entities to the index.
+    @staticmethod
+    def update(entities):
+        taskqueue.add(url='/admin/index',
+                      params={ 'key': [str(e.key()) for e in entities] })
+
+    # Rebuilds the whole index from projection queries on the name
+    # properties, replacing every index entity.
+    @classmethod
+    def rebuild(cls):
+        entries = collections.defaultdict(set)
+        for kind, fields in cls.fields.items():
+            for field in fields:
+                q = db.Query(db.class_for_kind(kind), projection=(field,))
+                for e in q.run(batch_size=1000):
+                    for t in cls.trigrams(getattr(e, field)):
+                        entries[cls.keyName(kind, t)].add(e.key())
+        stale = [k for k in cls.all(keys_only=True)
+                 if k.name() not in entries]
+        for i in range(0, len(stale), 500):
+            db.delete(stale[i:i+500])
+        indexes = [cls(key_name=k, keys=list(keys))
+                   for k, keys in entries.items()]
+        for i in range(0, len(indexes), 100):
+            db.put(indexes[i:i+100])
+
+    # Returns a list of up to limit (score, entity) pairs for the
+    # entities of a kind whose names are most like name, best first.
+    # The score is the Dice coefficient of the names' trigrams, from 0
+    # to 1; pairs scoring less than minScore are left out.
+    @classmethod
+    def search(cls, kind, name, limit=10, minScore=0.5):
+        trigrams = cls.trigrams(name)
+        counts = collections.Counter()
+        for index in cls.get_by_key_name([cls.keyName(kind, t)
+                                          for t in trigrams]):
+            if index:
+                counts.update(index.keys)
+        candidates = db.get([k for k, n in counts.most_common(limit * 3)])
+        scored = []
+        for e in candidates:
+            if not e:
+                continue
+            score = max(2.0 * len(trigrams & ts) / (len(trigrams) + len(ts))
+                        for ts in [cls.trigrams(getattr(e, field))
+                                   for field in cls.fields[kind]])
+            if score >= minScore:
+                scored.append((score, e))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored[:limit]
+
 class Vote(db.Model):
     ballot = db.ReferenceProperty(Ballot, required=True)
+    year = db.IntegerProperty() # the ballot's year, for per-year queries
     category = db.StringProperty(default=Ballot.categories[0])
     rank = db.IntegerProperty(required=True) # 1-based rank within category
     release = db.ReferenceProperty(Release)
     artist = db.StringProperty(default='')
+    sortartist = db.StringProperty() # normalized artist, set by saveVotes
     title = db.StringProperty(default='')
     comments = db.TextProperty(default='')
 
@@ -307,6 +1101,20 @@ class Vote(db.Model):
     def link(self):
         return '<a href="%s">%s</a>' % (self.url(), self.ballot.name())
 
+    # Returns the normalized artist and title of a vote, which are the
+    # same for votes that name the same release.
+    @staticmethod
+    def canonKey(vote):
+        return mb.normalizeName(vote.artist), mb.normalizeName(vote.title)
+
+    # Returns a list of lists of votes grouped by canonKey, in order.
+    @staticmethod
+    def groups(votes):
+        groups = collections.defaultdict(list)
+        for v in votes:
+            groups[Vote.canonKey(v)].append(v)
+        return [groups[k] for k in sorted(groups)]
+
 class RankedRelease(db.Model):
     year = db.IntegerProperty(required=True)
     rank = db.IntegerProperty(required=True)
@@ -314,23 +1122,601 @@ class RankedRelease(db.Model):
     sortname = db.StringProperty()
     title = db.StringProperty()
     html = db.TextProperty()
+    # The checksum of the votes shown in the HTML (see VoteCounter), or
+    # None if it is yet to be rendered.
+    checksum = db.IntegerProperty()
+
+    # Stands for the rank in the HTML, so that a release whose rank
+    # changes need not be rendered again.
+    rankMarker = '<!-- rank -->'
+
+    @staticmethod
+    def keyName(year, release):
+        return '%d/%d' % (year, release.id())
 
-    def collectVotes(self):
-        votes = dict([[c, []] for c in Ballot.categories])
+    # Returns a dict mapping categories to lists of this release's
+    # votes for this year, sorted by voter name.  If given, votes must
+    # be all of the release's votes for this year, with their ballots
+    # (and voters) already fetched.
+    def collectVotes(self, votes=None):
+        if votes is None:
+            votes = self.release.votes()
+        else:
+            votes = sorted(votes, key=lambda v: (v.category, v.ballot.name()))
+        collected = dict([[c, []] for c in Ballot.categories])
         key = lambda v: (v.ballot.year, v.category)
-        for k, g in itertools.groupby(self.release.votes(), key):
+        for k, g in itertools.groupby(votes, key):
             if k[0] == self.year:
-                votes[k[1]] = list(g)
-        return votes
+                collected[k[1]] = list(g)
+        return collected
 
-    def generateHTML(self):
+    def generateHTML(self, votes=None):
         path = os.path.join(os.path.dirname(__file__), 'ranked.html')
-        vals = dict(rank=self.rank, link=self.release.link(),
-                    v=self.collectVotes())
+        vals = dict(rank=RankedRelease.rankMarker, link=self.release.link(),
+                    v=self.collectVotes(votes))
         return template.render(path, vals)
 
     def cache(self):
-        self.sortname = self.release.artist.sortname
-        self.title = self.release.title
-        self.html = self.generateHTML()
-        self.put()
+        RankedRelease.cacheAll([self])
+
+    # Caches the sort keys and rendered HTML for a chunk of ranked
+    # releases, all of the same year.  The releases, their artists and
+    # votes, and the votes' ballots and voters are all fetched up
+    # front, with one get per kind (see prefetch) and one query per
+    # release, so that rendering doesn't fetch each reference
+    # separately.
+    @classmethod
+    def cacheAll(cls, rrs):
+        if not rrs:
+            return
+        year = rrs[0].year
+        # Start all the vote queries before waiting on any of them.
+        queries = [Vote.all().filter('release =', r).filter('year =', year)
+                   .run(batch_size=100) for r in
+                   [cls.release.get_value_for_datastore(rr) for rr in rrs]]
+        prefetch(rrs, 'release.artist')
+        votes = [list(q) for q in queries]
+        prefetch([v for vs in votes for v in vs], 'ballot.voter')
+        for rr, vs in zip(rrs, votes):
+            rr.sortname = rr.release.artist.sortname
+            rr.title = rr.release.title
+            rr.html = rr.generateHTML(vs)
+            rr.checksum = VoteCounter.checksumOf(vs)
+        db.put(rrs)
+
+# A RankJob tracks the tasks caching the ranked releases of a poll
+# year, in chunks, so that the results pages are flushed exactly when
+# the last chunk has been cached.  There is one per year, keyed by the
+# year; each ranking starts a new generation of it.  The outcome of
+# each chunk is kept in a RankChunk, so the chunk tasks don't contend
+# on the job.
+class RankJob(db.Model):
+    year = db.IntegerProperty(required=True)
+    generation = db.IntegerProperty(default=0)
+    releases = db.ListProperty(int, indexed=False)  # release IDs, ranked
+    numChunks = db.IntegerProperty(default=0)
+    started = db.DateTimeProperty()
+    finished = db.DateTimeProperty()
+
+    chunkSize = 20
+
+    # Starts a new generation of the job for a year's ranked releases,
+    # adding the chunk tasks in batches.
+    @classmethod
+    def start(cls, year, rrs):
+        def txn():
+            job = cls.get_by_key_name(str(year))
+            if job:
+                job.generation += 1
+            else:
+                job = cls(key_name=str(year), year=year)
+            job.releases = [RankedRelease.release.get_value_for_datastore(rr)
+                            .id() for rr in rrs]
+            job.numChunks = ((len(job.releases) + cls.chunkSize - 1)
+                             / cls.chunkSize)
+            job.started = datetime.datetime.now()
+            job.finished = None
+            job.put()
+            return job
+        job = db.run_in_transaction(txn)
+        db.delete(RankChunk.all(keys_only=True).ancestor(job))
+        job.addTasks(range(job.numChunks))
+        if not job.numChunks:
+            taskqueue.add(url='/admin/%d/flush' % year)
+        return job
+
+    # Adds the tasks for the given chunks, at most 100 per batch.
+    def addTasks(self, chunks):
+        tasks = [taskqueue.Task(url='/admin/%d/cache' % self.year,
+                                params={ 'generation': self.generation,
+                                         'chunk': chunk })
+                 for chunk in chunks]
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), 100):
+            queue.add(tasks[i:i+100])
+
+    # Returns the keys of the ranked releases in the given chunk.
+    def chunkKeys(self, chunk):
+        ids = self.releases[chunk*self.chunkSize:(chunk+1)*self.chunkSize]
+        return [db.Key.from_path(RankedRelease.kind(), '%d/%d' % (self.year, id))
+                for id in ids]
+
+    # Returns a pair of a list of the chunks cached and a list of the
+    # RankChunks of the chunks whose last attempt failed, for the
+    # current generation.
+    def progress(self):
+        chunks = [c for c in RankChunk.all().ancestor(self)
+                  if c.generation == self.generation]
+        return ([c.chunk for c in chunks if c.error is None],
+                [c for c in chunks if c.error is not None])
+
+    # Returns the number of chunks of the current generation cached so
+    # far, without fetching the chunks.  The ancestor query is strongly
+    # consistent, so the last chunk to finish sees all the others.
+    def chunksDone(self):
+        q = RankChunk.all(keys_only=True).ancestor(self)
+        q.filter('generation =', self.generation).filter('error =', None)
+        return q.count(limit=self.numChunks)
+
+    # Records that a chunk of the given generation has been cached, or
+    # failed with the given error.  When the last chunk is cached, the
+    # results pages are flushed.
+    @classmethod
+    def finishChunk(cls, year, generation, chunk, error=None):
+        job = cls.get_by_key_name(str(year))
+        if not job or job.generation != generation:
+            return
+        if error:
+            error = ('Chunk %d: %s' % (chunk, error))[:500]
+        RankChunk(parent=job, key_name='%d/%d' % (generation, chunk),
+                  generation=generation, chunk=chunk, error=error).put()
+        if error or job.chunksDone() < job.numChunks:
+            return
+        def txn():
+            job = cls.get_by_key_name(str(year))
+            if job.generation != generation or job.finished:
+                return
+            job.finished = datetime.datetime.now()
+            job.put()
+            taskqueue.add(url='/admin/%d/flush' % year, transactional=True)
+        db.run_in_transaction(txn)
+
+    # Adds the tasks for the failed chunks again.
+    def retry(self):
+        self.addTasks([c.chunk for c in self.progress()[1]])
+
+# A RankChunk records the outcome of the last attempt to cache a chunk
+# of a RankJob generation.  It is a child of the job, keyed by the
+# generation and chunk, and is stored without a transaction.
+class RankChunk(db.Model):
+    generation = db.IntegerProperty(required=True)
+    chunk = db.IntegerProperty(required=True)
+    error = db.StringProperty() # None if the chunk was cached
+
+# A VoteCounter is one shard of the number of ballots counting a
+# release in a category for a poll year.  The counters are updated
+# whenever a vote's release or category changes, so ranking only has
+# to sum the shards instead of recounting every vote.
+class VoteCounter(db.Model):
+    year = db.IntegerProperty(required=True)
+    release = db.ReferenceProperty(Release, required=True)
+    category = db.StringProperty(required=True)
+    count = db.IntegerProperty(default=0)
+    # The sum of the vote hashes of the ballots counted (see voteHash).
+    checksum = db.IntegerProperty(default=0)
+
+    numShards = 5
+
+    # The task queue for the changes to the counters (see queue.yaml).
+    queueName = 'counters'
+
+    @staticmethod
+    def keyName(year, release, category, shard):
+        return '%d/%s/%s/%d' % (year, release, category, shard)
+
+    # Returns a hash of a ballot counting a release in a category.  The
+    # checksum of a release's votes is the sum of the hashes of the
+    # ballots counting it, so it can be kept up to date a ballot at a
+    # time, and two sets of votes almost never have the same one.
+    @staticmethod
+    def voteHash(ballot, category):
+        return int(hashlib.sha1('%s %s' % (ballot, category))
+                   .hexdigest()[:15], 16)
+
+    # Returns checksum with delta times the hash of a ballot counting a
+    # release in a category added.
+    @classmethod
+    def addHash(cls, checksum, ballot, category, delta):
+        return (checksum + delta * cls.voteHash(ballot, category)) % 2**62
+
+    # Returns the checksum of the given votes, all for one release.
+    @classmethod
+    def checksumOf(cls, votes):
+        checksum = 0
+        byBallot = lambda v: Vote.ballot.get_value_for_datastore(v)
+        for ballot, vs in itertools.groupby(sorted(votes, key=byBallot),
+                                            byBallot):
+            for category in Ballot.countedReleases(vs).values():
+                checksum = cls.addHash(checksum, ballot, category, 1)
+        return checksum
+
+    # Enqueues the changes to the counters for the given ballot of the
+    # given year whose counted releases (see Ballot.countedReleases)
+    # went from before to after.  If called in a transaction, the task
+    # is only enqueued if the transaction commits.
+    @classmethod
+    def update(cls, year, before, after, uncanonicalized=0, ballot=None):
+        deltas = collections.defaultdict(int)
+        for release, category in before.items():
+            deltas[release, category] -= 1
+        for release, category in after.items():
+            deltas[release, category] += 1
+        params = { 'delta': ['%d %s %d %s %s' % (year, category, delta,
+                                                 release, ballot)
+                             for (release, category), delta in deltas.items()
+                             if delta] }
+        if uncanonicalized:
+            params['uncanonicalized'] = '%d %d' % (year, uncanonicalized)
+        if params['delta'] or uncanonicalized:
+            taskqueue.add(url='/admin/counters', params=params,
+                          queue_name=cls.queueName,
+                          transactional=db.is_in_transaction())
+
+    # Raises CountersBusy if there are counter tasks in the queue.  The
+    # queue statistics lag by a few seconds, so this only guards
+    # against the votes being changed around a reconcile, which must
+    # not happen.
+    @classmethod
+    def checkIdle(cls):
+        stats = QueueStatistics.fetch(Queue(cls.queueName))
+        if stats.tasks or stats.in_flight:
+            raise CountersBusy('%d vote counter tasks are pending.'
+                               % (stats.tasks + stats.in_flight))
+
+    # Adds delta to a random shard of a counter, and checksum to its
+    # checksum.  The marker names this change, so that it is applied
+    # only once even if the task applying it is retried.
+    @classmethod
+    def increment(cls, year, release, category, delta, marker, checksum=0):
+        cls.adjust(year, [(release, category, delta, checksum)], marker)
+
+    # Applies changes, a list of (release key, category, delta,
+    # checksum) tuples for distinct counters, to random shards in one
+    # transaction, once per marker (see increment).
+    @classmethod
+    def adjust(cls, year, changes, marker):
+        keyNames = [cls.keyName(year, release, category,
+                                random.randrange(cls.numShards))
+                    for release, category, delta, checksum in changes]
+        def txn():
+            if CounterMarker.get_by_key_name(marker):
+                return
+            counters = cls.get_by_key_name(keyNames)
+            for i, (release, category, delta, checksum) in enumerate(changes):
+                if not counters[i]:
+                    counters[i] = cls(key_name=keyNames[i], year=year,
+                                      release=release, category=category)
+                counters[i].count += delta
+                counters[i].checksum = ((counters[i].checksum + checksum)
+                                        % 2**62)
+            db.put(counters + [CounterMarker(key_name=marker)])
+        db.run_in_transaction_options(db.create_transaction_options(xg=True),
+                                      txn)
+
+    # Returns a pair of dicts mapping release keys to lists of vote
+    # counts, one per category, and to the checksums of their votes,
+    # summed over all the shards for the given year.
+    @classmethod
+    def sums(cls, year):
+        count = dict()
+        checksums = collections.defaultdict(int)
+        for c in cls.all().filter('year =', year).run(batch_size=1000):
+            release = cls.release.get_value_for_datastore(c)
+            if release not in count:
+                count[release] = [0] * len(Ballot.categories)
+            count[release][Ballot.categories.index(c.category)] += c.count
+            checksums[release] = (checksums[release] + c.checksum) % 2**62
+        count = dict((r, c) for r, c in count.items() if any(c))
+        return count, dict((r, checksums[r]) for r in count)
+
+    # Corrects the counters for the given year to the given counts and
+    # checksums, in the form returned by sums, tallied from the votes
+    # after the counters were read as before and before they were read
+    # as after.  The votes must not change meanwhile, and no counter
+    # tasks may be pending (see Poll.reconcileCounters); a change whose
+    # task ran during the tally anyway shows up as a difference between
+    # before and after, and its release is left for the next reconcile.
+    # The corrections are added with adjust, under the same markers as
+    # the counter tasks.  Returns a list of (release key, category,
+    # counted, actual) tuples for the counters that had drifted.
+    @classmethod
+    def reconcile(cls, year, count, checksums, before, after):
+        zero = [0] * len(Ballot.categories)
+        changes = []
+        drift = []
+        for release in set(count) | set(before[0]) | set(after[0]):
+            counted = before[0].get(release, zero)
+            checksum = before[1].get(release, 0)
+            if (after[0].get(release, zero) != counted or
+                after[1].get(release, 0) != checksum):
+                logging.info('Votes for %s changed while tallying' % release)
+                continue
+            actual = count.get(release, zero)
+            # The whole checksum correction goes on one counter.
+            correction = (checksums.get(release, 0) - checksum) % 2**62
+            for category, c, a in zip(Ballot.categories, counted, actual):
+                if a != c:
+                    drift.append((release, category, c, a))
+                if a != c or correction:
+                    changes.append((release, category, a - c, correction))
+                    correction = 0
+        # Each counter and the marker is an entity group, and a
+        # transaction can use at most 25.
+        marker = 'reconcile/%d/%f' % (year, time.time())
+        for i in range(0, len(changes), 12):
+            cls.adjust(year, changes[i:i+12], '%s/%d' % (marker, i))
+        return drift
+
+# Raised when the vote counters can't be reconciled because the votes
+# may be changing.
+class CountersBusy(Exception):
+    pass
+
+# A CounterMarker records that a change to a VoteCounter was applied.
+class CounterMarker(db.Model):
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    # Deletes the markers more than a day old, by which time their
+    # tasks are long done.
+    @classmethod
+    def expire(cls):
+        q = db.GqlQuery('SELECT __key__ FROM CounterMarker WHERE created < :1',
+                        datetime.datetime.now() - datetime.timedelta(days=1))
+        while True:
+            keys = q.fetch(500)
+            db.delete(keys)
+            if len(keys) < 500:
+                return
+
+# A CanonQueue is the work queue of a poll year's uncanonicalized votes.
+# It holds the number of them, kept up to date from the ballots' counts
+# by the counter tasks, and a cursor just past the last one handed out
+# by next, so that each next is a single indexed query.
+class CanonQueue(db.Model):
+    count = db.IntegerProperty(default=0)
+    cursor = db.TextProperty()
+
+    @staticmethod
+    def query(year):
+        return Vote.gql('WHERE year = :1 AND release = :2 '
+                        'ORDER BY sortartist', year, None)
+
+    @classmethod
+    def forYear(cls, year):
+        return cls.get_by_key_name(str(year)) or cls(key_name=str(year))
+
+    # Adds delta to the count for a year, once per marker (see
+    # VoteCounter.increment).
+    @classmethod
+    def increment(cls, year, delta, marker):
+        def txn():
+            if CounterMarker.get_by_key_name(marker):
+                return
+            queue = cls.forYear(year)
+            queue.count += delta
+            db.put([queue, CounterMarker(key_name=marker)])
+        db.run_in_transaction_options(db.create_transaction_options(xg=True),
+                                      txn)
+
+    # Sets the count for a year by counting the votes.
+    @classmethod
+    def recount(cls, year):
+        count = cls.query(year).count(limit=None)
+        def txn():
+            queue = cls.forYear(year)
+            queue.count = count
+            queue.put()
+        db.run_in_transaction(txn)
+
+    # Returns the next uncanonicalized vote for a year after the last
+    # one returned, going back to the first after the last, or None if
+    # there are none left.
+    @classmethod
+    def next(cls, year):
+        queue = cls.forYear(year)
+        q = cls.query(year)
+        if queue.cursor:
+            q.with_cursor(queue.cursor)
+        vote = q.get()
+        if not vote and queue.cursor:
+            q = cls.query(year)
+            vote = q.get()
+        cursor = q.cursor()
+        def txn():
+            queue = cls.forYear(year)
+            queue.cursor = cursor
+            queue.put()
+        db.run_in_transaction(txn)
+        return vote
+
+# A Backup is an export of the stored data into BackupChunks, each a
+# gzip-compressed file of JSON lines, one per entity.  It is written a
+# batch at a time by a chain of tasks, each starting from the kind and
+# cursor stored by the last one, so a failed task just resumes where it
+# left off.  Only the primary data is backed up; the counters, rankings
+# and indexes can be rebuilt from it.
+class Backup(db.Model):
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty()
+    kind = db.StringProperty()   # the kind being exported, None when done
+    cursor = db.TextProperty()   # where the next batch of that kind starts
+    numChunks = db.IntegerProperty(default=0)
+    numEntities = db.IntegerProperty(default=0)
+
+    kinds = ['Globals', 'Poll', 'Voter', 'Ballot', 'Vote', 'Artist', 'Release']
+    batchSize = 500
+    maxChunkSize = 900000  # bytes compressed, under the entity size limit
+
+    @classmethod
+    def start(cls):
+        backup = cls(kind=cls.kinds[0])
+        backup.put()
+        backup.addTask()
+        return backup
+
+    def addTask(self, transactional=False):
+        taskqueue.add(url='/admin/backup/%d/export' % self.key().id(),
+                      transactional=transactional)
+
+    # Returns the keys of the chunks written so far, in order.  Their
+    # names are their file names, without the extension.
+    def chunkKeys(self):
+        return BackupChunk.all(keys_only=True).ancestor(self).order('__key__')
+
+    # Exports the next batch of the current kind into a chunk, and adds
+    # the task for the batch after it.  A batch too big for one chunk is
+    # halved until it fits.
+    def exportBatch(self):
+        if not self.kind:
+            return
+        n = self.batchSize
+        while True:
+            q = db.class_for_kind(self.kind).all()
+            if self.cursor:
+                q.with_cursor(self.cursor)
+            entities = q.fetch(n)
+            content = BackupChunk.encode(entities)
+            if len(content) <= self.maxChunkSize or n == 1:
+                break
+            n /= 2
+        kind, cursor = self.kind, self.cursor
+        if len(entities) < n:
+            i = self.kinds.index(kind) + 1
+            nextKind = self.kinds[i] if i < len(self.kinds) else None
+            nextCursor = None
+        else:
+            nextKind, nextCursor = kind, q.cursor()
+        def txn():
+            backup = db.get(self.key())
+            # A retried task may find its batch already exported.
+            if (backup.kind, backup.cursor) != (kind, cursor):
+                return backup
+            put = [backup]
+            if entities:
+                put.append(BackupChunk(
+                    parent=backup,
+                    key_name='%06d-%s' % (backup.numChunks, kind),
+                    kind=kind, count=len(entities),
+                    content=db.Blob(content)))
+                backup.numChunks += 1
+                backup.numEntities += len(entities)
+            backup.kind, backup.cursor = nextKind, nextCursor
+            if nextKind:
+                backup.addTask(transactional=True)
+            else:
+                backup.finished = datetime.datetime.now()
+            db.put(put)
+            return backup
+        return db.run_in_transaction(txn)
+
+# A BackupChunk is a batch of the entities of one kind in a Backup.
+class BackupChunk(db.Model):
+    kind = db.StringProperty()
+    count = db.IntegerProperty()
+    content = db.BlobProperty()   # gzip-compressed JSON lines
+
+    timeFormat = '%Y-%m-%d %H:%M:%S.%f'
+
+    # Returns the gzip-compressed JSON lines for a list of entities.
+    # Each line has the entity's key and its properties' stored values;
+    # references are stored as keys.
+    @classmethod
+    def encode(cls, entities):
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        for e in entities:
+            properties = {}
+            for name, prop in e.properties().items():
+                properties[name] = cls.encodeValue(
+                    prop.get_value_for_datastore(e))
+            f.write(simplejson.dumps({ 'key': str(e.key()),
+                                       'properties': properties }) + '\n')
+        f.close()
+        return buf.getvalue()
+
+    @classmethod
+    def encodeValue(cls, value):
+        if isinstance(value, list):
+            return [cls.encodeValue(v) for v in value]
+        if isinstance(value, db.Key):
+            return str(value)
+        if isinstance(value, datetime.datetime):
+            return value.strftime(cls.timeFormat)
+        if isinstance(value, users.User):
+            return { 'email': value.email(),
+                     'auth_domain': value.auth_domain(),
+                     'user_id': value.user_id() }
+        if isinstance(value, db.Blob):
+            return base64.b64encode(value)
+        return value
+
+    # Returns a list of the entities in gzip-compressed JSON lines made
+    # by encode, with their original keys.
+    @classmethod
+    def decode(cls, content):
+        entities = []
+        for line in gzip.GzipFile(fileobj=StringIO.StringIO(content)):
+            record = simplejson.loads(line)
+            key = db.Key(record['key'])
+            model = db.class_for_kind(key.kind())
+            properties = {}
+            for name, value in record['properties'].items():
+                properties[str(name)] = cls.decodeValue(
+                    model.properties()[name], value)
+            entities.append(model(key=key, **properties))
+        return entities
+
+    @classmethod
+    def decodeValue(cls, prop, value):
+        if value is None:
+            return None
+        if isinstance(prop, db.ListProperty):
+            return [cls.decodeItem(prop.item_type, v) for v in value]
+        if isinstance(prop, db.ReferenceProperty):
+            return db.Key(value)
+        return cls.decodeItem(prop.data_type, value)
+
+    @classmethod
+    def decodeItem(cls, dataType, value):
+        if dataType is db.Key:
+            return db.Key(value)
+        if dataType is datetime.datetime:
+            return datetime.datetime.strptime(value, cls.timeFormat)
+        if dataType is users.User:
+            return users.User(email=value['email'],
+                              _auth_domain=value['auth_domain'],
+                              _user_id=value['user_id'])
+        if dataType is db.Blob:
+            return db.Blob(base64.b64decode(value))
+        if dataType in (db.Text, db.Link):
+            return dataType(value)
+        return value
+
+    # Stores the entities in a chunk's content with batched puts, and
+    # reserves their numeric ids so that new entities won't reuse them.
+    # Returns the number of entities restored.
+    @classmethod
+    def restore(cls, content, batchSize=200):
+        entities = cls.decode(content)
+        for i in range(0, len(entities), batchSize):
+            db.put(entities[i:i+batchSize])
+        maxIds = {}
+        for e in entities:
+            key = e.key()
+            if key.id():
+                group = (key.parent(), key.kind())
+                maxIds[group] = max(maxIds.get(group, 0), key.id())
+        for (parent, kind), maxId in maxIds.items():
+            db.allocate_id_range(db.Key.from_path(kind, maxId, parent=parent),
+                                 1, maxId)
+        return len(entities)
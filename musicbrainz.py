@@ -1,9 +1,19 @@
 # Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
 # General Public License v3.  See COPYING for details.
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import db
 import urllib
-from xml.dom import minidom
+import urlparse
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+import datetime
+import hashlib
+import re
+import StringIO
 import time
 
 mbns = 'http://musicbrainz.org/ns/mmd-1.0#'
@@ -15,46 +25,307 @@ extns = 'http://musicbrainz.org/ns/ext-1.0#'
 # ourselves go.  So instead we have to go through a proxy at a
 # different address.
 
+proxyURL = 'http://steak.place.org/servlets/mb-mirror.ss'
+
 def proxify(url):
-    return ('http://steak.place.org/servlets/mb-mirror.ss?'
-            + urllib.urlencode({ 'url': url }))
-
-def xmlHttpRequest(url):
-    time.sleep(1)
-    url = proxify(url)
-    response = urlfetch.fetch(url, deadline=10)
-    if response.status_code != 200:
-        raise HTTPError(url, response)
-    return minidom.parseString(response.content)
-
-class Resource:
+    return proxyURL + '?' + urllib.urlencode({ 'url': url })
+
+# Starts fetching a URL, returning an RPC whose get_result method
+# returns the urlfetch response.  It can be replaced, e.g. to use a
+# local stub server.
+def fetchAsync(url, deadline=None):
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url)
+    return rpc
+
+# A token bucket rate limiter, shared by all instances through
+# memcache.  Up to burst requests can be made at once, refilled at rate
+# requests per second.
+class TokenBucket(object):
+    def __init__(self, key, rate=1.0, burst=1):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+
+    # Waits until a token is available, and takes it.  If memcache
+    # fails or is contended maxAttempts times in a row, it just waits
+    # for one token's worth of time instead.
+    def take(self, maxAttempts=10):
+        client = memcache.Client()
+        for attempt in range(maxAttempts):
+            now = time.time()
+            state = client.gets(self.key, namespace='TokenBucket')
+            if state is None:
+                if client.add(self.key, (self.burst - 1, now),
+                              namespace='TokenBucket'):
+                    return
+                continue
+            tokens, last = state
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                if client.cas(self.key, (tokens - 1, now),
+                              namespace='TokenBucket'):
+                    return
+                continue
+            time.sleep((1 - tokens) / self.rate)
+        time.sleep(1 / self.rate)
+
+# The Web service allows one request per second on average.  A burst of
+# two lets CanonPage's search and its fallback run concurrently.
+bucket = TokenBucket('musicbrainz', burst=2)
+
+# A CachedResponse is a Web service response, keyed by a hash of its
+# normalized URL, with a memcache copy in front of it.  Not-found
+# responses are cached too, for less time.
+class CachedResponse(db.Model):
+    url = db.TextProperty()
+    status_code = db.IntegerProperty()
+    content = db.BlobProperty()
+    expires = db.DateTimeProperty()
+
+    ttls = { 200: datetime.timedelta(days=30),
+             404: datetime.timedelta(days=1) }
+
+    @staticmethod
+    def keyName(url):
+        return hashlib.sha1(url).hexdigest()
+
+    # Returns the unexpired cached response for a normalized URL, or None.
+    @classmethod
+    def lookup(cls, url):
+        keyName = cls.keyName(url)
+        response = memcache.get(keyName, namespace=cls.kind())
+        if response is None:
+            response = cls.get_by_key_name(keyName)
+            if response:
+                memcache.add(keyName, response, namespace=cls.kind())
+        if response and response.expires > datetime.datetime.now():
+            return response
+
+    # Caches a response to a normalized URL if its status is cacheable.
+    # Returns the response.
+    @classmethod
+    def store(cls, url, response):
+        ttl = cls.ttls.get(response.status_code)
+        if not ttl:
+            return response
+        keyName = cls.keyName(url)
+        cached = cls(key_name=keyName, url=url,
+                     status_code=response.status_code,
+                     content=db.Blob(response.content),
+                     expires=datetime.datetime.now() + ttl)
+        cached.put()
+        memcache.set(keyName, cached, namespace=cls.kind())
+        return cached
+
+# Returns a URL with its query parameters in a canonical order, so that
+# equivalent requests share cache entries.
+def normalize(url):
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(query, True)))
+    return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+# A Web service request, answered from the cache if possible.  Only
+# requests that miss the cache wait for the rate limiter; the fetch
+# then runs in the background until get_result is called.
+class Request(object):
+    def __init__(self, url):
+        self.url = normalize(url)
+        self.response = CachedResponse.lookup(self.url)
+        self.rpc = None
+        if not self.response:
+            bucket.take()
+            self.rpc = fetchAsync(proxify(self.url), deadline=10)
+
+    # Returns the content of the response, waiting for it if necessary.
+    def get_result(self):
+        if self.rpc:
+            self.response = CachedResponse.store(self.url,
+                                                 self.rpc.get_result())
+            self.rpc = None
+        if self.response.status_code != 200:
+            raise HTTPError(proxify(self.url), self.response)
+        return self.response.content
+
+# Returns the content of the response to a Web service URL.
+def request(url):
+    return Request(url).get_result()
+
+# A pending Web service lookup, whose get_result method parses the
+# response once it arrives.
+class Lookup(object):
+    def __init__(self, request, parse):
+        self.request = request
+        self.parse = parse
+
+    def get_result(self):
+        return self.parse(self.request.get_result())
+
+    # Waits for the response, which caches it, without parsing it.
+    def cache(self):
+        try:
+            self.request.get_result()
+        except (HTTPError, urlfetch.Error):
+            pass
+
+# A lookup that was answered without a request.
+class Result(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get_result(self):
+        return self.value
+
+    def cache(self):
+        pass
+
+# Returns an artist name or title reduced to lowercase words, without
+# punctuation or a leading "the", so that trivially different spellings
+# of the same name compare equal.
+def normalizeName(name):
+    words = re.sub(r'[^\w\s]', '', name.lower(), flags=re.UNICODE).split()
+    if len(words) > 1 and words[0] == 'the':
+        words = words[1:]
+    return ' '.join(words)
+
+# The local store is loaded from a MusicBrainz data dump by
+# import_musicbrainz.py, and is consulted before the Web service.  Its
+# entities are keyed by MBID, and only their normalized names (see
+# normalizeName) and artist MBIDs are indexed.
+
+class LocalArtist(db.Model):
+    name = db.StringProperty(indexed=False)
+    sortname = db.StringProperty(indexed=False)
+    disambiguation = db.StringProperty(indexed=False)
+    normname = db.StringProperty()
+
+# A LocalReleaseGroup holds the first artist credited for it.
+class LocalReleaseGroup(db.Model):
+    type = db.StringProperty(indexed=False)
+    title = db.StringProperty(indexed=False)
+    normtitle = db.StringProperty()
+    artistid = db.StringProperty()
+    artistname = db.StringProperty(indexed=False)
+    artistsortname = db.StringProperty(indexed=False)
+    normartist = db.StringProperty()
+
+    def artist(self):
+        return LocalArtist(key_name=self.artistid, name=self.artistname,
+                           sortname=self.artistsortname,
+                           normname=self.normartist)
+
+class Resource(object):
+    __slots__ = ()
+
     @classmethod
     def url(cls):
-        return 'http://musicbrainz.org/ws/1/' + cls.type + '/'
+        return 'http://musicbrainz.org/ws/1/' + cls.resource + '/'
 
     @classmethod
-    def getElement(cls, id, *inc):
+    def elementURL(cls, id, *inc):
         fields = { 'type': 'xml', 'inc': ' '.join(inc) }
-        url = cls.url() + id + '?' + urllib.urlencode(fields)
-        doc = xmlHttpRequest(url)
-        return elementField(doc.documentElement, cls.type)
+        return cls.url() + id + '?' + urllib.urlencode(fields)
 
     @classmethod
-    def searchElements(cls, **fields):
+    def searchURL(cls, **fields):
         for key in fields:
             fields[key] = fields[key].encode('utf-8')
         fields['type'] = 'xml'
-        url = cls.url() + '?' + urllib.urlencode(fields)
-        doc = xmlHttpRequest(url)
-        return doc.getElementsByTagNameNS(mbns, cls.type)
+        return cls.url() + '?' + urllib.urlencode(fields)
+
+    @classmethod
+    def firstElement(cls, content):
+        for elt in iterElements(content, cls.resource):
+            return elt
+
+    # Returns the local record for an id, or None.
+    @classmethod
+    def getLocal(cls, id):
+        return cls.localModel.get_by_key_name(id)
+
+    @classmethod
+    def getElement(cls, id, *inc):
+        return cls.firstElement(request(cls.elementURL(id, *inc)))
+
+    @classmethod
+    def iterSearchElements(cls, **fields):
+        return iterElements(request(cls.searchURL(**fields)), cls.resource)
+
+    @classmethod
+    def search(cls, **fields):
+        return cls.searchAsync(**fields).get_result()
+
+    # Returns a list of the exact matches for a search in the local
+    # store, scored 100, or None if there are none or the search can't
+    # be done locally.
+    @classmethod
+    def searchLocal(cls, **fields):
+        q = cls.localQuery(**fields)
+        if q is None:
+            return None
+        results = [cls(local=local) for local in q.fetch(100)]
+        for r in results:
+            r.score = '100'
+        return results or None
+
+    # Starts a search, returning a Lookup of the list of results, which
+    # come from the local store if it has any.
+    @classmethod
+    def searchAsync(cls, **fields):
+        results = cls.searchLocal(**fields)
+        if results:
+            return Result(results)
+        return Lookup(Request(cls.searchURL(**fields)), lambda content:
+            [cls(elt=elt) for elt in iterElements(content, cls.resource)])
+
+    # Returns a list of the results of a search if they are stored
+    # locally or its response is cached, or None, without making a
+    # request.
+    @classmethod
+    def searchCached(cls, **fields):
+        results = cls.searchLocal(**fields)
+        if results:
+            return results
+        response = CachedResponse.lookup(normalize(cls.searchURL(**fields)))
+        if response and response.status_code == 200:
+            return [cls(elt=elt)
+                    for elt in iterElements(response.content, cls.resource)]
+
+    # Starts fetching a resource by id, returning a Lookup of it.
+    @classmethod
+    def getAsync(cls, id):
+        local = cls.getLocal(id)
+        if local:
+            return Result(cls(local=local))
+        return Lookup(Request(cls.elementURL(id, *cls.inc)), lambda content:
+            cls(elt=cls.firstElement(content)))
+
+    # Yields the search results as they are parsed.
+    @classmethod
+    def iterSearch(cls, **fields):
+        for elt in cls.iterSearchElements(**fields):
+            yield cls(elt=elt)
 
 class Artist(Resource):
-    type = 'artist'
-    def __init__(self, id=None, elt=None):
-        if elt == None:
-            elt = self.getElement(id)
-        self.score = elt.getAttributeNS(extns, 'score')
-        self.id = elt.getAttribute('id')
+    resource = 'artist'
+    inc = ()
+    localModel = LocalArtist
+    __slots__ = ('score', 'id', 'name', 'sortname', 'disambiguation')
+
+    def __init__(self, id=None, elt=None, local=None):
+        if elt == None and local == None:
+            local = self.getLocal(id)
+            if not local:
+                elt = self.getElement(id, *self.inc)
+        if local:
+            self.score = None
+            self.id = local.key().name()
+            self.name = local.name
+            self.sortname = local.sortname
+            self.disambiguation = local.disambiguation
+            return
+        self.score = attribute(elt, '{%s}score' % extns)
+        self.id = attribute(elt, 'id')
         self.name = elementFieldValue(elt, 'name')
         self.sortname = elementFieldValue(elt, 'sort-name')
         self.disambiguation = elementFieldValue(elt, 'disambiguation')
@@ -62,42 +333,87 @@ class Artist(Resource):
     def releaseGroups(self):
         return ReleaseGroup.search(artistid=self.id)
 
-    @classmethod
-    def search(cls, **fields):
-        artists = cls.searchElements(**fields)
-        return [Artist(elt=elt) for elt in artists]
+    @staticmethod
+    def localQuery(name=None, **fields):
+        if name and not fields:
+            return LocalArtist.all().filter('normname =', normalizeName(name))
 
 class ReleaseGroup(Resource):
-    type = 'release-group'
-    def __init__(self, id=None, elt=None):
-        if elt == None:
-            elt = self.getElement(id, 'artist')
-        self.score = elt.getAttributeNS(extns, 'score')
-        self.id = elt.getAttribute('id')
-        self.type = elt.getAttribute('type')
+    resource = 'release-group'
+    inc = ('artist',)
+    localModel = LocalReleaseGroup
+    __slots__ = ('score', 'id', 'type', 'artist', 'title')
+
+    def __init__(self, id=None, elt=None, local=None):
+        if elt == None and local == None:
+            local = self.getLocal(id)
+            if not local:
+                elt = self.getElement(id, *self.inc)
+        if local:
+            self.score = None
+            self.id = local.key().name()
+            self.type = local.type
+            self.artist = Artist(local=local.artist())
+            self.title = local.title
+            return
+        self.score = attribute(elt, '{%s}score' % extns)
+        self.id = attribute(elt, 'id')
+        self.type = attribute(elt, 'type')
         self.artist = Artist(elt=elementField(elt, 'artist'))
         self.title = elementFieldValue(elt, 'title')
 
-    @classmethod
-    def search(cls, **fields):
-        rgs = cls.searchElements(**fields)
-        return [ReleaseGroup(elt=elt) for elt in rgs]
+    @staticmethod
+    def localQuery(title=None, artist=None, artistid=None, **fields):
+        if fields or not (title or artist or artistid):
+            return None
+        q = LocalReleaseGroup.all()
+        if title:
+            q.filter('normtitle =', normalizeName(title))
+        if artistid:
+            q.filter('artistid =', artistid)
+        elif artist:
+            q.filter('normartist =', normalizeName(artist))
+        return q
+
+# Yields the outermost elements of an XML document with the given
+# MusicBrainz tag name, in document order, as they are parsed.  Each
+# element is cleared once the caller is done with it, so the whole
+# document is never held in memory.
+def iterElements(content, tagName):
+    tag = '{%s}%s' % (mbns, tagName)
+    depth = 0
+    for event, elt in ElementTree.iterparse(StringIO.StringIO(content),
+                                            ('start', 'end')):
+        if elt.tag != tag:
+            continue
+        if event == 'start':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield elt
+                elt.clear()
 
+# Returns the first descendant of elt with the given MusicBrainz tag
+# name, or None.
 def elementField(elt, fieldName):
-    fields = elt.getElementsByTagNameNS(mbns, fieldName)
-    if fields:
-        return fields[0]
+    return elt.find('.//{%s}%s' % (mbns, fieldName))
 
 def elementFieldValue(elt, fieldName):
     field = elementField(elt, fieldName)
-    if field:
+    if field is not None:
         return textContent(field)
 
-# Node.textContent is only in DOM Level 3...
-def textContent(node):
-    node.normalize()
-    return ''.join(node.data for node in node.childNodes
-                   if node.nodeType == node.TEXT_NODE)
+# Returns the value of an attribute as unicode, or '' if it's missing,
+# as the DOM does.
+def attribute(elt, name):
+    return unicode(elt.get(name, ''))
+
+# Returns the text directly inside an element, not in its children, as
+# the DOM's textContent did for the elements we read.
+def textContent(elt):
+    return unicode(''.join([elt.text or ''] +
+                           [child.tail or '' for child in elt]))
 
 
 class HTTPError(Exception):
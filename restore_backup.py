@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
+# General Public License v3.  See COPYING for details.
+
+# Restores the chunk files of a backup downloaded from /admin/backup,
+# keeping the entities' keys, and so the references between them.
+# Restoring a chunk twice is harmless, so an interrupted restore can be
+# run again.
+#
+# Usage: restore_backup.py [-d sdk] [-H host] app_id chunkfile...
+
+import getpass
+import optparse
+import os
+import sys
+
+def auth_func():
+    return raw_input('Username:'), getpass.getpass('Password:')
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [-d sdk] [-H host] app_id chunkfile...')
+    parser.add_option('-d', dest='sdk', default='/home/dougo/google_appengine')
+    parser.add_option('-H', dest='host')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('specify an app id and the chunk files')
+    app_id, files = args[0], args[1:]
+    host = options.host or '%s.appspot.com' % app_id
+
+    sys.path.insert(0, options.sdk)
+    sys.path.append(options.sdk + '/lib/yaml/lib')
+    sys.path.append(options.sdk + '/lib/webob')
+    sys.path.append(options.sdk + '/lib/django')
+    sys.path.append(options.sdk + '/lib/antlr')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from google.appengine.ext.remote_api import remote_api_stub
+    from models import BackupChunk
+    remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api',
+                                             auth_func, host)
+
+    total = 0
+    for f in sorted(files):
+        n = BackupChunk.restore(open(f, 'rb').read())
+        total += n
+        print '%s: %d entities restored' % (f, n)
+    print 'Done: %d entities.' % total
+
+if __name__ == '__main__':
+    main()
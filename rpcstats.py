@@ -0,0 +1,232 @@
+# Copyright 2009-2010 Doug Orleans.  Distributed under the GNU Affero
+# General Public License v3.  See COPYING for details.
+
+# Per-request statistics on API calls, gathered by apiproxy hooks.
+# StatsMiddleware wraps the WSGI application: for each request it
+# counts the datastore, memcache, urlfetch and taskqueue calls made,
+# their latency and the entities they carry, flags repeated calls of
+# the same shape (the N+1 pattern), logs a summary line (and adds it as
+# a header for admins), and keeps a sample of the recent requests for
+# each route in memcache for the admin stats page.
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import users
+import collections
+import logging
+import random
+import re
+import time
+
+services = ['datastore_v3', 'memcache', 'urlfetch', 'taskqueue']
+
+# The number of calls of one shape in a request that is flagged.
+repeatThreshold = 10
+
+# The number of recent requests kept for each route.
+historySize = 20
+
+# The fraction of requests kept, since keeping one costs two memcache
+# calls.
+sampleRate = 0.1
+
+# The statistics for the request being handled, or None.  The app is
+# not threadsafe, so there is only one at a time.
+current = None
+
+class RequestStats(object):
+    def __init__(self, route):
+        self.route = route
+        self.start = time.time()
+        self.elapsed = None
+        self.calls = collections.defaultdict(int)     # by service
+        self.latency = collections.defaultdict(float) # by service, in ms
+        self.entities = 0
+        self.shapes = collections.defaultdict(int)
+        self.pending = dict()
+
+    def preCall(self, service, call, request):
+        self.pending[id(request)] = time.time()
+        self.calls[service] += 1
+        self.shapes[shape(service, call, request)] += 1
+
+    def postCall(self, service, call, request, response):
+        start = self.pending.pop(id(request), None)
+        if start is not None:
+            self.latency[service] += (time.time() - start) * 1000
+        self.entities += entityCount(service, call, request, response)
+
+    def finish(self):
+        if self.elapsed is None:
+            self.elapsed = (time.time() - self.start) * 1000
+
+    # Returns a list of (shape, count) pairs for the shapes of call
+    # repeated at least repeatThreshold times.
+    def repeated(self):
+        return sorted([(s, n) for s, n in self.shapes.items()
+                       if n >= repeatThreshold], key=lambda p: -p[1])
+
+    def summary(self):
+        parts = ['%dms' % self.elapsed]
+        for s in services:
+            if self.calls[s]:
+                parts.append('%s=%d/%dms' % (s, self.calls[s],
+                                             self.latency[s]))
+        parts.append('entities=%d' % self.entities)
+        for s, n in self.repeated():
+            parts.append('repeated %dx %s' % (n, s))
+        return ' '.join(parts)
+
+    def record(self):
+        return dict(time=self.start, elapsed=self.elapsed,
+                    calls=dict(self.calls), latency=dict(self.latency),
+                    entities=self.entities, repeated=self.repeated())
+
+def preCall(service, call, request, response):
+    if current and service in services:
+        current.preCall(service, call, request)
+
+def postCall(service, call, request, response):
+    if current and service in services:
+        current.postCall(service, call, request, response)
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpcstats', preCall)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpcstats', postCall)
+
+# Returns a string describing the shape of a call: the service, the
+# method, and for datastore calls the kinds and the properties filtered
+# or sorted on, but not the values.
+def shape(service, call, request):
+    name = '%s.%s' % (service, call)
+    try:
+        if service != 'datastore_v3':
+            return name
+        if call in ('Get', 'Delete'):
+            kinds = set(k.path().element_list()[-1].type()
+                        for k in request.key_list())
+            return '%s %s' % (name, ','.join(sorted(kinds)))
+        if call == 'Put':
+            kinds = set(e.key().path().element_list()[-1].type()
+                        for e in request.entity_list())
+            return '%s %s' % (name, ','.join(sorted(kinds)))
+        if call == 'RunQuery':
+            props = [p.name() for f in request.filter_list()
+                     for p in f.property_list()]
+            props.extend('order:' + o.property()
+                         for o in request.order_list())
+            if request.has_ancestor():
+                props.append('ancestor')
+            return '%s %s(%s)' % (name, request.kind(), ','.join(props))
+    except AttributeError:
+        pass
+    return name
+
+# Returns the number of entities or keys a datastore call carried.
+def entityCount(service, call, request, response):
+    if service != 'datastore_v3':
+        return 0
+    try:
+        if call in ('Get', 'Delete'):
+            return request.key_size()
+        if call == 'Put':
+            return request.entity_size()
+        if call in ('RunQuery', 'Next'):
+            return response.result_size()
+    except AttributeError:
+        pass
+    return 0
+
+# Adds a request's record to the recent history of its route, a list
+# kept in memcache under the route.  Updates lost to contention are
+# dropped.
+def remember(route, record):
+    client = memcache.Client()
+    for attempt in range(3):
+        records = client.gets(route, namespace='RPCStats')
+        if records is None:
+            if client.add(route, [record], namespace='RPCStats'):
+                return
+            continue
+        records.append(record)
+        del records[:-historySize]
+        if client.cas(route, records, namespace='RPCStats'):
+            return
+
+# Returns a list of aggregates of the recent history of the given
+# routes, for those that have any.  Each is a dict with the route, the
+# number of requests, their mean time, calls and latency by service
+# and entities, and the shapes of call flagged as repeated, with the
+# number of requests flagging each.
+def aggregates(routes):
+    history = memcache.get_multi(routes, namespace='RPCStats')
+    result = []
+    for route in routes:
+        records = history.get(route)
+        if not records:
+            continue
+        n = len(records)
+        calls = collections.defaultdict(int)
+        latency = collections.defaultdict(float)
+        repeated = collections.defaultdict(int)
+        for r in records:
+            for s, c in r['calls'].items():
+                calls[s] += c
+            for s, l in r['latency'].items():
+                latency[s] += l
+            for s, c in r['repeated']:
+                repeated[s] += 1
+        result.append(dict(
+            route=route, requests=n,
+            elapsed=sum(r['elapsed'] for r in records) / n,
+            services=[(s, float(calls[s]) / n, latency[s] / n)
+                      for s in services if calls[s]],
+            entities=float(sum(r['entities'] for r in records)) / n,
+            repeated=sorted(repeated.items(), key=lambda p: -p[1])))
+    return result
+
+# WSGI middleware gathering the statistics of each request.  Requests
+# are grouped by the route pattern they match, from the same list of
+# (pattern, handler) pairs as the application, and their method.  The
+# requests to the route patterns in unkept, such as frequent
+# background saves, are only logged.
+class StatsMiddleware(object):
+    def __init__(self, app, routes, unkept=()):
+        self.app = app
+        self.routes = [(re.compile('^%s$' % pattern), pattern)
+                       for pattern, handler in routes]
+        self.unkept = set(unkept)
+
+    # Returns the names of all the routes, in order.
+    def routeNames(self):
+        patterns = [pattern for regexp, pattern in self.routes] + ['(none)']
+        return ['%s %s' % (method, pattern) for pattern in patterns
+                for method in ('GET', 'POST')]
+
+    def route(self, environ):
+        path = environ.get('PATH_INFO', '')
+        for regexp, pattern in self.routes:
+            if regexp.match(path):
+                return '%s %s' % (environ.get('REQUEST_METHOD'), pattern)
+        return '%s (none)' % environ.get('REQUEST_METHOD')
+
+    def __call__(self, environ, start_response):
+        global current
+        stats = current = RequestStats(self.route(environ))
+        def start(status, headers, exc_info=None):
+            stats.finish()
+            if users.is_current_user_admin():
+                headers.append(('X-RPC-Stats', stats.summary()))
+            return start_response(status, headers, exc_info)
+        try:
+            return self.app(environ, start)
+        finally:
+            current = None
+            stats.finish()
+            summary = '%s: %s' % (stats.route, stats.summary())
+            if stats.repeated():
+                logging.warning(summary)
+            else:
+                logging.info(summary)
+            pattern = stats.route.split(' ', 1)[1]
+            if pattern not in self.unkept and random.random() < sampleRate:
+                remember(stats.route, stats.record())